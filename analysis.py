@@ -0,0 +1,107 @@
+""" Lazy loading of the simulation results, for plots and summaries """
+import glob
+import os
+
+import pandas as pd
+
+# columns measured by the simulation, everything else is a parameter
+# ('selfish' and 'altruistic' are found in older result files)
+METRICS = ['altruistic_tx', 'altruistic_rx', 'selfish_tx', 'selfish_rx',
+           'selfish_num', 'altruistic_num', 'selfish', 'altruistic']
+
+KEY = 'results'
+
+
+def shards(path):
+    """ Files of a result set.
+
+    path is a single HDF5 file, a directory holding the rotated
+    simulation_results_N_*.hdf5 files or a glob pattern.
+    """
+    if os.path.isdir(path):
+        path = os.path.join(path, 'simulation_results_*.hdf5')
+    paths = sorted(glob.glob(path))
+    if not paths:
+        raise FileNotFoundError("No result files match {}".format(path))
+    return paths
+
+
+def condition(**values):
+    """ where= string selecting rows with the given column values """
+    terms = []
+    for column, value in sorted(values.items()):
+        if hasattr(value, 'item'):
+            value = value.item()
+        # repr keeps floats exact, so they match the stored values
+        terms.append("{} == {!r}".format(column, value))
+    return " & ".join(terms) or None
+
+
+def iter_chunks(paths, where=None, columns=None, chunksize=500000):
+    """ Yield frames of at most chunksize rows across all the shards.
+
+    where and columns are passed to PyTables: only the rows and columns
+    asked are read from disk, using the data_columns written by the runner.
+    """
+    for path in paths:
+        with pd.HDFStore(path, mode='r') as store:
+            if KEY not in store:
+                continue
+            if not store.get_storer(KEY).is_table:
+                # fixed format files cannot be queried: filter in memory
+                frame = store.select(KEY)
+                if where is not None:
+                    frame = frame.query(where)
+                yield frame[columns] if columns is not None else frame
+                continue
+            for chunk in store.select(KEY, where=where, columns=columns,
+                                      chunksize=chunksize):
+                yield chunk
+
+
+def select(paths, where=None, columns=None):
+    """ All the matching rows as a single frame """
+    frames = list(iter_chunks(paths, where=where, columns=columns))
+    if not frames:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(frames, ignore_index=True)
+
+
+def columns_of(paths):
+    """ Columns of the result table, reading its first row only """
+    with pd.HDFStore(paths[0], mode='r') as store:
+        return list(store.select(KEY, stop=1).columns)
+
+
+def distinct(paths, column):
+    """ Sorted distinct values of a column, reading that column only """
+    values = set()
+    for path in paths:
+        with pd.HDFStore(path, mode='r') as store:
+            if KEY not in store:
+                continue
+            if store.get_storer(KEY).is_table:
+                values.update(store.select_column(KEY, column).unique())
+            else:
+                values.update(store.select(KEY)[column].unique())
+    return sorted(values)
+
+
+def grouped_sum(paths, by, columns, where=None, chunksize=500000):
+    """ groupby(by)[columns].sum(), computed chunk by chunk.
+
+    Only the partial sums of the groups are kept in memory, never the
+    whole table; also returns the number of rows of each group, in the
+    column 'count', to compute means.
+    """
+    total = None
+    for chunk in iter_chunks(paths, where=where, columns=by + columns,
+                             chunksize=chunksize):
+        chunk = chunk.assign(count=1)
+        partial = chunk.groupby(by)[columns + ['count']].sum()
+        total = partial if total is None else total.add(partial,
+                                                        fill_value=0)
+
+    if total is None:
+        return pd.DataFrame(columns=by + columns + ['count']).set_index(by)
+    return total
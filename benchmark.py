@@ -0,0 +1,452 @@
+""" Micro-benchmarks for the simulator hot paths """
+import argparse
+import datetime
+import json
+import logging
+import multiprocessing as mp
+import platform
+import resource
+import sys
+import time
+import tracemalloc
+from itertools import count
+from random import Random, random, seed
+
+import networkx as nx
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+
+from simulator.core import Event, EventQueue, Packet, PacketPool, \
+    instrument, logger
+from simulator.topology import TOPOLOGIES
+from simulator_starter import scenarios
+from test_batman import geometry_cache, new_snapshot, setup_simulation
+
+# small scenario, with enough packets to time the per packet overhead
+SCENARIO = {'dim': 100, 'dist_lim': 100, 'node_num': 50, 'stop_time': 100,
+            'selfish_rate': 0.3, 'app_rate': 0.05, 's': 1000,
+            'update_time': 1, 'drop_lim': 10}
+
+
+# parameters completing the scenarios of the sweep in the suite
+SUITE_PARAMS = {'selfish_rate': 0.3, 'app_rate': 0.05, 'update_time': 1,
+                'drop_lim': 10}
+SUITE_SEEDS = [1000, 1001, 1002]
+
+# metrics of the suite where lower is better, all the others are rates
+LOWER_IS_BETTER = ('setup_time', 'peak_rss_mib')
+
+
+class SortedListEventQueue(EventQueue):
+    """ Old scheduler, re-sorting the whole list on every add """
+    def next(self):
+        if len(self.events) == 0:
+            return None
+
+        next_event = self.events.pop()
+        self.now = next_event.when
+
+        next_event.trigger()
+
+        return next_event
+
+    def add(self, event):
+        self.events.append(event)
+        self.events.sort(reverse=True)
+        return event
+
+
+class DictPacket:
+    """ Old packet, with a __dict__ and a header dict per instance """
+    def __init__(self, size, id_, header):
+        self.size = size
+        self.header = header
+        self.id_ = id_
+
+
+class DictEvent:
+    """ Old event, with a __dict__ """
+    def __init__(self, action, when):
+        self.action = action
+        self.when = when
+
+
+def _header(i):
+    return {'src_ip': i, 'src_port': 1000, 'dst_ip': i + 1,
+            'dst_port': 1001, 'tx_time': 0.5, 'path': [i + 1, i + 2]}
+
+
+def bench_memory(build, n):
+    """ Bytes per object built by build(i), traced with tracemalloc """
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    objects = [build(i) for i in range(n)]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    # do not count the list holding the objects
+    return (after - before) / n - 8 if objects else 0
+
+
+def bench_allocation(n, pool):
+    """ Packets per second created and discarded, with or without pool """
+    packets = PacketPool(count(1).__next__, reuse=pool)
+
+    start = time.perf_counter()
+    for i in range(n):
+        packet = packets.new(150, i, 1000, i + 1, 1001, 0.5)
+        packet.path = [i + 1]
+        packets.release(packet)
+    return n / (time.perf_counter() - start)
+
+
+def bench_event_queue(queue_class, pending, n_events):
+    """ Hold model: every event triggered schedules a new one.
+
+    Keeps `pending` events in the queue, like apps and channels do, and
+    returns the number of events per second (insert + pop).
+    """
+    seed(0)
+    queue = queue_class()
+
+    def action():
+        queue.add(Event(action, when=queue.now + random()))
+
+    for _ in range(pending):
+        queue.add(Event(action, when=random()))
+
+    start = time.perf_counter()
+    for _ in range(n_events):
+        queue.next()
+    elapsed = time.perf_counter() - start
+
+    return n_events / elapsed
+
+
+def bench_logging(mode, repeat, until=5.0):
+    """ Seconds per packet generated, with the given instrumentation mode.
+
+    Only the run is timed, over a fixed horizon: the snapshots go on until
+    then whatever their variation.
+    """
+    logger.setLevel(logging.DEBUG if mode == 'debug' else logging.INFO)
+    # keep debug records away from the terminal, only their cost matters
+    logger.propagate = mode != 'debug'
+    if mode == 'debug' and not logger.handlers:
+        logger.addHandler(logging.NullHandler())
+
+    best = float('inf')
+    for _ in range(repeat):
+        # array routes, so that the routing does not hide the overhead
+        sim = setup_simulation(dict(SCENARIO, topology='array',
+                                    thres_var=-1, trace=mode == 'trace'))
+        packets = sim.last_packet_id
+        start = time.perf_counter()
+        sim.run(until=until)
+        elapsed = time.perf_counter() - start
+        best = min(best, elapsed / (sim.last_packet_id - packets))
+
+    logger.setLevel(logging.NOTSET)
+    logger.propagate = True
+    instrument()
+    return best
+
+
+def peak_rss():
+    """ Peak resident set size of this process, in MiB """
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def bench_scenario(runs):
+    """ Build and run the simulation of every args in runs.
+
+    Meant to run in a fresh process, so that the peak RSS is the one of
+    these simulations only.
+    """
+    # import and warm up everything the setup touches, out of the timings
+    setup_simulation(dict(runs[0], node_num=2))
+
+    setup = float('inf')
+    elapsed = 0.0
+    events = packets = 0
+    for args in runs:
+        start = time.perf_counter()
+        sim = setup_simulation(args)
+        setup = min(setup, time.perf_counter() - start)
+
+        start = time.perf_counter()
+        while sim.step() is not None:
+            events += 1
+        elapsed += time.perf_counter() - start
+        packets += sim.last_packet_id
+
+    return {
+        'events_per_sec': events / elapsed,
+        'packets_per_sec': packets / elapsed,
+        'setup_time': setup,
+        'peak_rss_mib': peak_rss(),
+        'events': events,
+        'packets': packets,
+    }
+
+
+def bench_routes(topology, n_routes, node_num=200):
+    """ Dijkstra paths per second, after a weight change like in a run """
+    args = dict(SCENARIO, node_num=node_num, topology=topology)
+    sim = setup_simulation(args)
+    graph = sim.topology
+    edges = list(sim.topology.to_networkx().edges)
+    rand = Random(0)
+
+    elapsed = 0.0
+    for _ in range(n_routes):
+        # every transmission changes a weight, invalidating the paths
+        src_ip, dst_ip = rand.choice(edges)
+        graph.set_edge_weight(src_ip, dst_ip,
+                              graph.edge_weight(src_ip, dst_ip) + 1)
+        src, dst = rand.sample(range(node_num), 2)
+
+        start = time.perf_counter()
+        try:
+            graph.shortest_path(src, dst)
+        except nx.NetworkXNoPath:
+            pass
+        elapsed += time.perf_counter() - start
+    return n_routes / elapsed
+
+
+def check_routes(topology, n_routes, node_num=200):
+    """ Largest relative excess of the path costs over scipy's Dijkstra.
+
+    Edge weights move up and down, and a node weight every ten routes;
+    every path is compared with the distances of a matrix built from
+    scratch. Only for the topologies stored in arrays.
+    """
+    args = dict(SCENARIO, node_num=node_num, topology=topology)
+    graph = setup_simulation(args).topology
+    edges = list(graph.to_networkx().edges)
+    rand = Random(0)
+
+    worst = 0.0
+    for i in range(n_routes):
+        src_ip, dst_ip = rand.choice(edges)
+        graph.set_edge_weight(src_ip, dst_ip, graph.edge_weight(
+            src_ip, dst_ip) * rand.uniform(0.5, 1.5))
+        if i % 10 == 0:
+            graph.set_node_weight(rand.randrange(node_num), rand.randrange(3))
+        src, dst = rand.sample(range(node_num), 2)
+        try:
+            path = graph.shortest_path(src, dst)
+        except nx.NetworkXNoPath:
+            continue
+
+        cost = sum(graph.node_weight(u) / 2 + graph.node_weight(v) / 2 +
+                   graph.edge_weight(u, v) for u, v in zip(path, path[1:]))
+        m = len(graph.edge_index)
+        matrix = csr_matrix((graph.edge_costs(), (graph.edge_src[:m],
+                                                  graph.edge_dst[:m])),
+                            shape=(node_num, node_num))
+        distance = dijkstra(matrix, indices=graph.index[src])[
+            graph.index[dst]]
+        worst = max(worst, (cost - distance) / distance)
+    return worst
+
+
+def bench_setup(topology, repeat, node_num=200):
+    """ Best seconds to build the nodes, channels and apps of a scenario """
+    args = dict(SCENARIO, node_num=node_num, topology=topology)
+    best = float('inf')
+    for _ in range(repeat):
+        # time the construction of the geometry as well
+        geometry_cache.clear()
+        start = time.perf_counter()
+        setup_simulation(args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_snapshot(n):
+    """ Snapshots per second taken on a built scenario """
+    sim = setup_simulation(SCENARIO)
+    start = time.perf_counter()
+    for _ in range(n):
+        new_snapshot(sim)
+    return n / (time.perf_counter() - start)
+
+
+def run_suite(seeds, events, repeat):
+    """ Scenarios of the sweep and micro-benchmarks, as a JSON-able dict """
+    results = {
+        'meta': {
+            'date': datetime.datetime.utcnow().strftime('%Y-%m-%d-%H-%M-%S'),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'seeds': seeds,
+        },
+        'scenarios': {},
+        'micro': {},
+    }
+
+    # a new process per scenario, for its own peak RSS
+    context = mp.get_context('spawn')
+    for scenario in scenarios:
+        name = "dim{dim}_nodes{node_num}".format(**scenario)
+        runs = [dict(scenario, s=s, **SUITE_PARAMS) for s in seeds]
+        with context.Pool(1, maxtasksperchild=1) as pool:
+            results['scenarios'][name] = pool.apply(bench_scenario, (runs,))
+        print("scenario {:<16} {events_per_sec:>10.0f} ev/s "
+              "{packets_per_sec:>8.0f} pkt/s {peak_rss_mib:>7.1f} MiB".format(
+                  name, **results['scenarios'][name]))
+
+    micro = results['micro']
+    micro['event_queue'] = {
+        'events_per_sec': bench_event_queue(EventQueue, 1000, events)}
+    for topology in TOPOLOGIES:
+        micro['routes_' + topology] = {
+            'routes_per_sec': bench_routes(topology, events // 10)}
+        micro['setup_' + topology] = {
+            'setup_time': bench_setup(topology, repeat)}
+    micro['snapshot'] = {'snapshots_per_sec': bench_snapshot(events)}
+    for name, values in micro.items():
+        for metric, value in values.items():
+            print("micro {:<19} {:>16} {:>12.4g}".format(name, metric, value))
+
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """ Print the ratio of every metric to the baseline.
+
+    Returns the (group, name, metric) of the metrics worse than the
+    baseline by more than tolerance.
+    """
+    regressions = []
+    print("{:<40} {:>12} {:>12} {:>8}".format(
+        'metric', 'baseline', 'current', 'ratio'))
+    for group in ('scenarios', 'micro'):
+        for name, values in sorted(results[group].items()):
+            base_values = baseline.get(group, {}).get(name, {})
+            for metric, value in sorted(values.items()):
+                if metric not in base_values or metric in ('events',
+                                                           'packets'):
+                    continue
+                base = base_values[metric]
+                ratio = value / base if base else float('inf')
+                if metric in LOWER_IS_BETTER:
+                    worse = ratio > 1 + tolerance
+                else:
+                    worse = ratio < 1 - tolerance
+                if worse:
+                    regressions.append((group, name, metric))
+                print("{:<40} {:>12.4g} {:>12.4g} {:>7.2f}{}".format(
+                    name + '.' + metric, base, value, ratio,
+                    ' !' if worse else ''))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest='bench')
+
+    queue_parser = subparsers.add_parser('queue', help='event scheduler')
+    queue_parser.add_argument('-n', '--events', type=int, default=20000)
+    queue_parser.add_argument('-p', '--pending', type=int, nargs='+',
+                              default=[10, 100, 1000])
+
+    log_parser = subparsers.add_parser('logging', help='logthis overhead')
+    log_parser.add_argument('-r', '--repeat', type=int, default=3)
+    log_parser.add_argument('-u', '--until', type=float, default=5.0,
+                            help="simulated time of each timed run")
+
+    route_parser = subparsers.add_parser(
+        'routes', help='incremental routes against a full recompute')
+    route_parser.add_argument('-n', '--routes', type=int, default=2000)
+    route_parser.add_argument('-N', '--nodes', type=int, nargs='+',
+                              default=[200, 500, 1000])
+
+    pkt_parser = subparsers.add_parser('packets',
+                                       help='packet and event footprint')
+    pkt_parser.add_argument('-n', '--number', type=int, default=100000)
+
+    suite_parser = subparsers.add_parser(
+        'suite', help='scenarios of the sweep and micro-benchmarks')
+    suite_parser.add_argument('-s', '--seeds', type=int, nargs='+',
+                              default=SUITE_SEEDS)
+    suite_parser.add_argument('-n', '--events', type=int, default=20000)
+    suite_parser.add_argument('-r', '--repeat', type=int, default=3)
+    suite_parser.add_argument('-o', '--output', default=None,
+                              help="write the results to this JSON file")
+    suite_parser.add_argument('-b', '--baseline', default=None,
+                              help="JSON results of an earlier suite to "
+                              "compare with")
+    suite_parser.add_argument('-t', '--tolerance', type=float, default=0.1,
+                              help="relative change reported as a "
+                              "regression")
+
+    args = parser.parse_args()
+
+    if args.bench == 'queue':
+        print("{:>8} {:>16} {:>16} {:>8}".format(
+            'pending', 'heap [ev/s]', 'sorted [ev/s]', 'speedup'))
+        for pending in args.pending:
+            heap = bench_event_queue(EventQueue, pending, args.events)
+            legacy = bench_event_queue(SortedListEventQueue, pending,
+                                       args.events)
+            print("{:>8} {:>16.0f} {:>16.0f} {:>8.1f}".format(
+                pending, heap, legacy, heap / legacy))
+    elif args.bench == 'logging':
+        base = bench_logging('off', args.repeat, args.until)
+        print("{:>8} {:>16} {:>10}".format('mode', 'us/packet', 'overhead'))
+        for mode in ('off', 'trace', 'debug'):
+            per_packet = base if mode == 'off' else \
+                bench_logging(mode, args.repeat, args.until)
+            print("{:>8} {:>16.2f} {:>9.1%}".format(
+                mode, per_packet * 1e6, per_packet / base - 1))
+    elif args.bench == 'routes':
+        print("{:>6} {:>16} {:>16} {:>8} {:>10}".format(
+            'nodes', 'full [routes/s]', 'incr [routes/s]', 'speedup',
+            'max error'))
+        for node_num in args.nodes:
+            full = bench_routes('array', args.routes, node_num)
+            incremental = bench_routes('incremental', args.routes, node_num)
+            error = check_routes('incremental', args.routes // 4, node_num)
+            print("{:>6} {:>16.0f} {:>16.0f} {:>8.2f} {:>10.1e}".format(
+                node_num, full, incremental, incremental / full, error))
+    elif args.bench == 'packets':
+        n = args.number
+        print("{:>14} {:>12}".format('object', 'bytes'))
+        for name, build in (
+                ('dict packet', lambda i: DictPacket(150, i, _header(i))),
+                ('slot packet', lambda i: Packet(150, i, _header(i))),
+                ('dict event', lambda i: DictEvent(None, i * 0.5)),
+                ('slot event', lambda i: Event(None, i * 0.5))):
+            print("{:>14} {:>12.1f}".format(name, bench_memory(build, n)))
+
+        print("{:>14} {:>12}".format('allocator', 'packets/s'))
+        for name, pool in (('fresh', False), ('pool', True)):
+            print("{:>14} {:>12.0f}".format(name, bench_allocation(n, pool)))
+
+        sim = setup_simulation(SCENARIO)
+        sim.run()
+        print("full run: {} packets, {} allocated, {} recycled".format(
+            sim.last_packet_id, sim.packets.allocated, sim.packets.recycled))
+    elif args.bench == 'suite':
+        results = run_suite(args.seeds, args.events, args.repeat)
+        if args.output is not None:
+            with open(args.output, 'w') as file:
+                json.dump(results, file, indent=2, sort_keys=True)
+        if args.baseline is not None:
+            with open(args.baseline) as file:
+                baseline = json.load(file)
+            regressions = compare(results, baseline, args.tolerance)
+            if regressions:
+                print("{} regressions over {:.0%}".format(
+                    len(regressions), args.tolerance))
+                return 1
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
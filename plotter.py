@@ -1,7 +1,8 @@
 import matplotlib
 import matplotlib.pyplot as plt
 # import numpy as np
-import pandas as pd
+
+from analysis import condition, distinct, grouped_sum, shards
 
 font = {'family': 'normal',
         'size': 10}
@@ -10,24 +11,26 @@ matplotlib.rc('font', **font)
 
 FIXED_PARAM = 'time'
 
-data_original = pd.read_hdf("results/simulation_results_0_2019-02-16-14-26-33.hdf5")
+paths = shards("results/simulation_results_0_2019-02-16-14-26-33.hdf5")
 
-app_rates = list(set(data_original['app_rate']))
-node_nums = list(set(data_original['node_num']))
+app_rates = distinct(paths, 'app_rate')
+node_nums = distinct(paths, 'node_num')
 
 print(app_rates)
 print(node_nums)
 for node_num in node_nums:
     for app_rate in app_rates:
         print(node_num, app_rate)
-        data = data_original[
-            (data_original['node_num'] == node_num)
-            & (data_original['app_rate'] == app_rate)
-        ].groupby([FIXED_PARAM]).sum()
+        # filter in PyTables, summing only the columns plotted
+        data = grouped_sum(paths,
+                           by=[FIXED_PARAM],
+                           columns=['selfish_num', 'altruistic_num',
+                                    'node_num'],
+                           where=condition(node_num=node_num,
+                                           app_rate=app_rate))
 
         data['selfish_num'] /= data['node_num']
         data['altruistic_num'] /= data['node_num']
-        del data['s']
         # del data['selfish_num']
         # del data['altruistic_num']
 
@@ -0,0 +1,129 @@
+""" Content-addressed cache of simulation results """
+import glob
+import hashlib
+import os
+import pickle
+
+from simulator.util import atomic_write
+from sweep import args_key
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def code_version(root=HERE):
+    """ Hash of the sources a simulation result depends on """
+    paths = sorted(glob.glob(os.path.join(root, 'simulator', '*.py')))
+    paths.append(os.path.join(root, 'test_batman.py'))
+
+    digest = hashlib.sha256()
+    for path in paths:
+        digest.update(os.path.relpath(path, root).encode())
+        with open(path, 'rb') as file:
+            digest.update(file.read())
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """ Results stored on disk, one pickle file per (code, args) hash.
+
+    A simulation is deterministic given its args and the simulator code, so
+    the key is the hash of both: editing the simulator invalidates every
+    entry. Reading an entry refreshes its modification time, and when the
+    directory grows over max_bytes the least recently used entries are
+    removed. Several processes can share the same directory.
+    """
+    def __init__(self, cache_dir, max_bytes=10 * 2**30, version=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.version = version if version is not None else code_version()
+        os.makedirs(cache_dir, exist_ok=True)
+
+        # bytes written since the last check of the size of the directory
+        self.written = 0
+
+        self.hits = 0
+        self.misses = 0
+
+    def path(self, args):
+        key = hashlib.sha256(
+            (self.version + args_key(args)).encode()).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], key + '.pkl')
+
+    def get(self, args):
+        """ Return the cached result, or None """
+        path = self.path(args)
+        try:
+            with open(path, 'rb') as file:
+                result = pickle.load(file)
+            os.utime(path)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return result
+
+    def put(self, args, result):
+        path = self.path(args)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with atomic_write(path) as file:
+            pickle.dump(result, file, protocol=pickle.HIGHEST_PROTOCOL)
+
+        self.written += os.path.getsize(path)
+        # check the size once enough data have been added
+        if self.written > self.max_bytes / 100:
+            self.evict()
+
+    def evict(self):
+        """ Remove least recently used entries until under max_bytes """
+        self.written = 0
+        entries = []
+        total = 0
+        for path in glob.glob(os.path.join(self.cache_dir, '*', '*.pkl')):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                # removed by another process meanwhile
+                pass
+            total -= size
+
+
+# caches opened by this process, by directory
+_caches = {}
+
+
+class CachedFunction:
+    """ Picklable wrapper running function only on args not in the cache """
+    def __init__(self, function, cache_dir, max_bytes=10 * 2**30):
+        self.function = function
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.version = code_version()
+
+    @property
+    def cache(self):
+        # the wrapper is pickled with every task: keep one cache per process
+        key = (self.cache_dir, self.version)
+        if key not in _caches:
+            _caches[key] = ResultCache(self.cache_dir, self.max_bytes,
+                                       self.version)
+        return _caches[key]
+
+    def __call__(self, args):
+        result = self.cache.get(args)
+        if result is None:
+            result = self.function(args)
+            self.cache.put(args, result)
+        return result
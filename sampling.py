@@ -0,0 +1,298 @@
+""" Sequential replication of grid points over seeds, until their CI is tight
+"""
+import functools
+import hashlib
+import json
+import math
+import os
+import threading
+
+from scipy.stats import t as student_t
+
+from sweep import FLUSH, Manifest, args_key, normalize_args, to_tables
+
+END = 'end'
+
+
+def run_id(args):
+    """ Short id of a run, small enough for a string column """
+    return hashlib.sha1(args_key(args).encode()).hexdigest()[:16]
+
+
+def column_name(metric):
+    """ Column of a metric, 'a/b' (the ratio of two columns) is 'a_per_b' """
+    return metric.replace('/', '_per_')
+
+
+def end_value(row, metric):
+    if '/' not in metric:
+        return row[metric]
+    num, den = metric.split('/')
+    return row[num] / row[den] if row[den] else 0.0
+
+
+class EndMetrics:
+    """ Picklable wrapper adding the metrics of the last snapshot of a run.
+
+    The values are returned in the table 'end', with the id of the run, so
+    they can be matched with their args in the chunks of the sweep.
+    """
+    def __init__(self, function, metrics):
+        self.function = function
+        self.metrics = list(metrics)
+
+    def __call__(self, args):
+        tables = dict(to_tables(self.function(args)))
+        last = tables['results'][-1]
+        row = {'run': run_id(args)}
+        for metric in self.metrics:
+            row[column_name(metric)] = end_value(last, metric)
+        tables[END] = [row]
+        return tables
+
+
+@functools.lru_cache(maxsize=None)
+def t_quantile(confidence, dof):
+    """ Two-sided Student t quantile, cached: scipy's ppf is slow """
+    return float(student_t.ppf((1 + confidence) / 2, dof))
+
+
+class RunningStats:
+    """ Running mean and variance (Welford) of one metric of a point """
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add(self, value):
+        self.n += 1
+        delta = value - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (value - self.mean)
+
+    @property
+    def std(self):
+        return math.sqrt(self.m2 / (self.n - 1)) if self.n > 1 else math.inf
+
+    def half_width(self, confidence):
+        """ Half width of the confidence interval of the mean """
+        if self.n < 2:
+            return math.inf
+        quantile = t_quantile(confidence, self.n - 1)
+        return quantile * self.std / math.sqrt(self.n)
+
+
+class SeedSampler:
+    """ Runs of the grid points over seeds, in rounds, until they converge.
+
+    Iterating the sampler yields the args of the runs for the sweep: first
+    min_seeds seeds of every point, then rounds of round_seeds more seeds
+    for the points whose metrics are still noisy, noisiest first. A point
+    has converged when the confidence half width of every metric is below
+    rel_width times its mean (or abs_width); it also stops once all seeds
+    are used. When no point can go on before the pending results come
+    back, the sampler yields FLUSH and waits.
+
+    on_result must be called with the results of the runs, wrapped in
+    EndMetrics with the same metrics: the metrics of every run are also
+    appended to log_path, from which a restarted sweep resumes. The log
+    is written before the results are stored: with manifest_path, only
+    the runs also listed in that manifest are taken from it, the others
+    run again.
+    """
+    def __init__(self, points, seeds, metrics, log_path, min_seeds=10,
+                 round_seeds=10, rel_width=0.05, abs_width=0.0,
+                 confidence=0.95, manifest_path=None):
+        self.points = [normalize_args(point) for point in points]
+        self.seeds = list(seeds)
+        self.metrics = list(metrics)
+        self.min_seeds = min_seeds
+        self.round_seeds = round_seeds
+        self.rel_width = rel_width
+        self.abs_width = abs_width
+        self.confidence = confidence
+
+        self.stats = [{metric: RunningStats() for metric in self.metrics}
+                      for _ in self.points]
+        # seeds used so far by each point, and the runs still pending
+        self.used = [0] * len(self.points)
+        self.pending = {
+            # run id: (point index, seed)
+        }
+        self.done = set()
+        self.condition = threading.Condition()
+
+        # convergence and noise of each point, updated by _record
+        self._converged = [False] * len(self.points)
+        self._noise = [math.inf] * len(self.points)
+        for idx in range(len(self.points)):
+            self._update(idx)
+
+        self._replay(log_path, manifest_path)
+        self.log = open(log_path, 'a')
+
+    def _replay(self, log_path, manifest_path):
+        if not os.path.exists(log_path):
+            return
+        stored = None
+        if manifest_path is not None:
+            manifest = Manifest(manifest_path)
+            manifest.close()
+            stored = manifest.done
+
+        index = {args_key(point): idx for idx, point in enumerate(self.points)}
+        with open(log_path) as file:
+            for line in file:
+                # the last line may be truncated by a crash
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                idx = index.get(args_key(entry['point']))
+                if idx is None or entry['run'] in self.done:
+                    continue
+                if stored is not None and \
+                   args_key(self._run(idx, entry['s'])) not in stored:
+                    continue
+                self._record(idx, entry['run'], entry['values'])
+
+        # go on from the first seed without a result: _issue skips the
+        # ones done after it
+        for idx in range(len(self.points)):
+            while self.used[idx] < len(self.seeds) and run_id(
+                    self._run(idx, self.seeds[self.used[idx]])) in self.done:
+                self.used[idx] += 1
+
+    def _record(self, idx, run, values):
+        self.done.add(run)
+        for metric in self.metrics:
+            self.stats[idx][metric].add(values[column_name(metric)])
+        self._update(idx)
+
+    def _update(self, idx):
+        """ Check the convergence of idx against its current stats """
+        converged = True
+        noise = 0
+        for stats in self.stats[idx].values():
+            target = max(self.rel_width * abs(stats.mean), self.abs_width)
+            half_width = stats.half_width(self.confidence)
+            converged = converged and half_width <= target
+            noise = max(noise, half_width / target if target else math.inf)
+        self._converged[idx] = converged
+        self._noise[idx] = noise
+
+    def _run(self, idx, seed):
+        return dict(self.points[idx], s=seed)
+
+    def _issue(self, idx, count):
+        """ Args of the next count seeds of point idx """
+        runs = []
+        with self.condition:
+            for seed in self.seeds[self.used[idx]:self.used[idx] + count]:
+                self.used[idx] += 1
+                args = self._run(idx, seed)
+                if run_id(args) in self.done:
+                    continue
+                self.pending[run_id(args)] = (idx, seed)
+                runs.append(args)
+        return runs
+
+    def converged(self, idx):
+        return self._converged[idx]
+
+    def noise(self, idx):
+        """ Largest half width of the metrics of idx, relative to target """
+        return self._noise[idx]
+
+    def _next_round(self):
+        """ Noisiest point ready for a new round, None if there is none.
+
+        Also returns whether any point may still need a round later.
+        """
+        busy = {idx for idx, _ in self.pending.values()}
+        ready = []
+        waiting = False
+        for idx in range(len(self.points)):
+            if self.used[idx] >= len(self.seeds) or self._converged[idx]:
+                continue
+            if idx in busy:
+                waiting = True
+            else:
+                ready.append(idx)
+        if not ready:
+            return None, waiting
+        return max(ready, key=self._noise.__getitem__), True
+
+    def __iter__(self):
+        for idx in range(len(self.points)):
+            yield from self._issue(idx, max(0, self.min_seeds -
+                                            self.used[idx]))
+
+        while True:
+            with self.condition:
+                idx, alive = self._next_round()
+            if idx is not None:
+                yield from self._issue(idx, self.round_seeds)
+                continue
+            if not alive:
+                return
+
+            # submit what is collected, then wait for some results
+            yield FLUSH
+            with self.condition:
+                while True:
+                    idx, alive = self._next_round()
+                    if idx is not None or not alive:
+                        break
+                    self.condition.wait()
+
+    def on_result(self, args, result):
+        """ Record the end metrics of a run, or of a chunk of runs """
+        if isinstance(args, list):
+            columns = result.get(END, {})
+            rows = [dict(zip(columns, values))
+                    for values in zip(*columns.values())]
+        else:
+            rows = to_tables(result).get(END, [])
+
+        with self.condition:
+            for row in rows:
+                if row['run'] not in self.pending:
+                    continue
+                idx, seed = self.pending.pop(row['run'])
+                values = {column_name(metric): float(row[column_name(metric)])
+                          for metric in self.metrics}
+                self._record(idx, row['run'], values)
+                self.log.write(json.dumps({
+                    'point': self.points[idx],
+                    's': seed,
+                    'run': row['run'],
+                    'values': values,
+                }) + '\n')
+            self.log.flush()
+            self.condition.notify_all()
+
+    def on_done(self, args):
+        """ The run of args will give no result: failed or skipped """
+        with self.condition:
+            self.pending.pop(run_id(args), None)
+            self.condition.notify_all()
+
+    def summary(self):
+        """ One row per point: its seeds and the CI of its metrics """
+        rows = []
+        for idx, point in enumerate(self.points):
+            row = dict(point)
+            row['seeds'] = self.stats[idx][self.metrics[0]].n
+            row['converged'] = self.converged(idx)
+            for metric, stats in self.stats[idx].items():
+                name = column_name(metric)
+                row[name + '_mean'] = stats.mean
+                row[name + '_std'] = stats.std if stats.n > 1 else 0.0
+                half_width = stats.half_width(self.confidence)
+                row[name + '_ci'] = half_width if stats.n > 1 else 0.0
+            rows.append(row)
+        return rows
+
+    def close(self):
+        self.log.close()
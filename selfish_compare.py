@@ -1,16 +1,14 @@
-import ast
-from pathlib import Path
+from analysis import METRICS, columns_of, grouped_sum, shards
 
-import numpy as np
-import pandas as pd
+paths = shards("results/simulation_results.hdf5")
 
-results = pd.read_hdf("results/simulation_results.hdf5")
+# group by every parameter, summing the metrics chunk by chunk
+columns = columns_of(paths)
+variables = [column for column in columns if column not in METRICS]
+metrics = [column for column in columns if column in METRICS]
 
-variables = list(results.columns)
-for non_param in ('selfish_num', 'altruistic_num', 'selfish', 'altruistic'):
-    variables.remove(non_param)
-
-summary = results.groupby(variables).sum()
+summary = grouped_sum(paths, by=variables, columns=metrics)
+del summary['count']
 
 # element-by-element division
 
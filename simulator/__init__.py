@@ -1,2 +1,5 @@
 from .core import *
 from .layers import *
+from .topology import *
+from .routing import *
+from .simulation import *
@@ -0,0 +1,162 @@
+import numpy as np
+from scipy.sparse import block_diag
+
+from .core import Event
+
+# columns of the totals, in the order of MetricsCollector.snapshot
+TOTALS = ('altruistic_tx', 'altruistic_rx', 'selfish_tx', 'selfish_rx',
+          'selfish_num', 'altruistic_num')
+
+
+class Batch:
+    """ K replicas of the same scenario, advanced in lock-step.
+
+    Each replica is a Simulation built with its own seed. Packets keep
+    flowing through the event queue of their replica, but the control
+    events (snapshots and strategy updates) only pause it: once all the
+    replicas are paused at the same control event, it is handled for all
+    of them at once. The selfish flags and drop scores of the nodes live
+    in (K, nodes) arrays, the layers of replica k seeing row k, so the
+    strategy update is a single product with a block diagonal adjacency;
+    the snapshot totals and the history of selfish_num, used for the
+    convergence test, are (K, ...) arrays too.
+
+    The events of every replica are triggered in the same order as in a
+    run on its own, so each replica gives exactly the snapshots of the
+    plain simulation with its seed.
+    """
+    def __init__(self, sims, strategy, snapshot_time, update_time,
+                 thres_var, history=10):
+        self.sims = list(sims)
+        self.strategy = strategy
+        self.snapshot_time = snapshot_time
+        self.update_time = update_time
+        self.thres_var = thres_var
+
+        n_nodes = {sim.strategy._n_nodes for sim in self.sims}
+        if len(n_nodes) != 1:
+            raise ValueError("All the replicas must have the same number "
+                             "of nodes, got {}".format(sorted(n_nodes)))
+        n = n_nodes.pop()
+
+        # state of the nodes of every replica, shared with its layers
+        self.selfish = np.array([sim.strategy.selfish[:n]
+                                 for sim in self.sims])
+        self.drop_score = np.array([sim.strategy.drop_score[:n]
+                                    for sim in self.sims])
+        for k, sim in enumerate(self.sims):
+            sim.strategy.selfish = self.selfish[k]
+            sim.strategy.drop_score = self.drop_score[k]
+            sim.batch = self
+
+        adjacency = [sim.strategy.adjacency() for sim in self.sims]
+        self.adjacency = block_diag(adjacency, format='csr')
+        self.n_neigh = np.diff(self.adjacency.indptr).reshape(len(adjacency),
+                                                              n)
+
+        # last values of selfish_num of each replica, as ring buffers
+        self.history = np.zeros((len(self.sims), history), dtype=np.int64)
+        self.history_len = np.zeros(len(self.sims), dtype=np.int64)
+        self.history_pos = np.zeros(len(self.sims), dtype=np.int64)
+
+        self.replica = {id(sim): k for k, sim in enumerate(self.sims)}
+        # control event each replica is paused at: (when, kind, action)
+        self.paused = [None] * len(self.sims)
+        self._pausing = [None] * len(self.sims)
+
+    def pause(self, sim, kind):
+        """ Called by the control events of sim, in place of their action """
+        self._pausing[self.replica[id(sim)]] = kind
+
+    def _advance(self, k):
+        """ Run replica k until its next control event, False if done """
+        sim = self.sims[k]
+        while True:
+            event = sim.step()
+            if event is None:
+                return False
+            kind = self._pausing[k]
+            if kind is not None:
+                self._pausing[k] = None
+                self.paused[k] = (event.when, kind, event.action)
+                return True
+
+    def run(self, until=None):
+        """ Run until all the replicas are done, or up to the last control
+        event not after until """
+        live = set(range(len(self.sims)))
+        while live:
+            for k in list(live):
+                if self.paused[k] is None and not self._advance(k):
+                    live.discard(k)
+            if not live:
+                break
+
+            # replicas are independent: handle the earliest control event
+            when, kind = min(self.paused[k][:2] for k in live)
+            if until is not None and when > until:
+                break
+            group = [k for k in sorted(live)
+                     if self.paused[k][:2] == (when, kind)]
+            if kind == 'snapshot':
+                self._snapshot(group, when)
+            else:
+                self._update(group, when)
+            for k in group:
+                self.paused[k] = None
+
+    def _reschedule(self, k, when):
+        action = self.paused[k][2]
+        self.sims[k].event_queue.add(Event(action, when=when))
+
+    def _update(self, group, now):
+        """ Strategy update of the replicas in group, all nodes at once """
+        selfish_neigh = self.adjacency.dot(
+            self.selfish.ravel().astype(np.int64)).reshape(self.selfish.shape)
+        drop_lim = self.sims[group[0]].drop_lim
+        new_selfish = self.strategy(self.selfish, self.drop_score,
+                                    selfish_neigh, self.n_neigh, drop_lim)
+
+        for k in group:
+            strategy = self.sims[k].strategy
+            for idx in np.flatnonzero(new_selfish[k] != self.selfish[k]):
+                strategy.metrics.set_selfish(strategy.ips[idx],
+                                             bool(new_selfish[k, idx]))
+            self.selfish[k] = new_selfish[k]
+            self._reschedule(k, now + self.update_time)
+
+    def _snapshot(self, group, now):
+        """ Snapshot and convergence test of the replicas in group """
+        totals = np.array([[snapshot[key] for key in TOTALS] for snapshot in
+                           (self.sims[k].metrics.snapshot() for k in group)],
+                          dtype=np.int64)
+        selfish_num = totals[:, TOTALS.index('selfish_num')]
+
+        # mean change over the history, like MetricsCollector.variation
+        history = self.history[group]
+        filled = np.arange(history.shape[1]) < self.history_len[group, None]
+        diff = (np.abs(selfish_num[:, None] - history) * filled).sum(axis=1)
+        diff = diff / history.shape[1]
+
+        pos = self.history_pos[group]
+        self.history[group, pos] = selfish_num
+        self.history_pos[group] = (pos + 1) % history.shape[1]
+        self.history_len[group] = np.minimum(self.history_len[group] + 1,
+                                             history.shape[1])
+
+        for i, k in enumerate(group):
+            sim = self.sims[k]
+            sim.snapshots.append({
+                'time': now,
+                **sim.args,
+                **dict(zip(TOTALS, totals[i].tolist()))
+            })
+            if diff[i] > self.thres_var:  # changed a lot: continue
+                self._reschedule(k, now + self.snapshot_time)
+            else:
+                sim.event_queue.clean()
+
+    @property
+    def snapshots(self):
+        """ Snapshots of all the replicas, in order of replica """
+        return [snapshot for sim in self.sims for snapshot in sim.snapshots]
@@ -1,17 +1,27 @@
 import logging
-from functools import total_ordering
+import os
+from heapq import heappop, heappush
+from itertools import count
 # from inspect import signature
 from types import FunctionType, GeneratorType
 
-import networkx as nx
+import numpy as np
 
 
 class Base:
+    # subclasses may declare __slots__ and have no __dict__
+    __slots__ = ()
+
+    def _attributes(self):
+        if hasattr(self, '__dict__'):
+            return self.__dict__.items()
+        return ((key, getattr(self, key, None)) for key in self.__slots__)
+
     # create a nice representation of current object
     def __repr__(self):
         arguments = []
 
-        for key, value in self.__dict__.items():
+        for key, value in self._attributes():
             if isinstance(value, FunctionType) or \
                isinstance(value, GeneratorType):
                 arguments.append("key: {}".format(value.__name__))
@@ -21,63 +31,139 @@ class Base:
         return "<{}({})>".format(self.__class__.__name__, ", ".join(arguments))
 
 
-@total_ordering
 class Event(Base):
+    # millions of events are created per run: keep them small
+    __slots__ = ('action', 'when', 'cancelled')
+
     def __init__(self, action, when):
         self.action = action
         self.when = when
+        self.cancelled = False
 
     def trigger(self):
         self.action()
 
+    def cancel(self):
+        """ Drop the event: the queue discards it instead of triggering it """
+        self.cancelled = True
+
     def __lt__(self, other):
         return self.when < other.when
 
-    def __eq__(self, other):
-        return self.when == other.when
+    def __le__(self, other):
+        return self.when <= other.when
 
 
 class EventQueue(Base):
-    def __init__(self):
+    """ Binary heap of (when, seq, event) entries: O(log n) add and next.
+
+    Events scheduled at the same time are triggered in insertion order,
+    unless lifo_ties is set: that reproduces the order of the old
+    sort-on-every-add list, which popped the last inserted event first.
+    Cancelled events are skipped lazily when they reach the top.
+    """
+    def __init__(self, lifo_ties=False):
         self.events = []
         self.now = 0
+        self.lifo_ties = lifo_ties
+        self._seq = count()
 
     def next(self):
         # declare stop running out of events
-        if len(self.events) == 0:
-            return None
+        while len(self.events) > 0:
+            when, _, next_event = heappop(self.events)
+            if next_event.cancelled:
+                continue
+
+            self.now = when
+            next_event.trigger()
+
+            return next_event
 
-        next_event = self.events.pop()
-        self.now = next_event.when
+        return None
 
-        next_event.trigger()
+    def next_time(self):
+        """ Time of the next event, without triggering it """
+        while len(self.events) > 0:
+            when, _, next_event = self.events[0]
+            if not next_event.cancelled:
+                return when
+            heappop(self.events)
 
-        return next_event
+        return None
 
     def add(self, event):
-        # add but keep list ordered
-        self.events.append(event)
-        self.events.sort(reverse=True)
+        # the sequence number breaks ties without comparing events
+        seq = next(self._seq)
+        if self.lifo_ties:
+            seq = -seq
+        heappush(self.events, (event.when, seq, event))
+
+        # return the event as a handle, so that it can be cancelled
+        return event
 
     def clean(self):
-        self.__init__()
+        self.__init__(lifo_ties=self.lifo_ties)
+
+    def __getstate__(self):
+        # itertools.count cannot be pickled: store its next value
+        state = dict(self.__dict__)
+        state['_seq'] = next(self._seq)
+        self._seq = count(state['_seq'])
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._seq = count(state['_seq'])
 
 
 class Packet(Base):
-    last_packet_id = 0
+    """ Packet with a fixed set of header fields.
+
+    The header fields are plain attributes; packet['field'] is still
+    accepted, and raises ValueError if the field has not been set. hops
+    counts the links the packet has crossed.
+    """
+    HEADER_FIELDS = ('src_ip', 'src_port', 'dst_ip', 'dst_port',
+                     'tx_time', 'path')
+    __slots__ = ('size', 'id_', 'hops') + HEADER_FIELDS
+
+    def __init__(self, size, id_, header=None):
+        self.reset(size, id_, header)
 
-    def __init__(self, size, header={}):
+    def reset(self, size, id_, header=None):
         self.size = size
-        self.header = header
 
-        Packet.last_packet_id += 1
-        self.id_ = Packet.last_packet_id
+        # unique in the simulation creating the packet
+        self.id_ = id_
+        self.hops = 0
+
+        self.src_ip = None
+        self.src_port = None
+        self.dst_ip = None
+        self.dst_port = None
+        self.tx_time = None
+        self.path = None
+
+        if header is not None:
+            for key, item in header.items():
+                self[key] = item
+
+    @property
+    def header(self):
+        return {key: getattr(self, key) for key in Packet.HEADER_FIELDS
+                if getattr(self, key) is not None}
 
     def __setitem__(self, key, item):
-        self.header[key] = item
+        if key not in Packet.HEADER_FIELDS:
+            raise KeyError(key)
+        setattr(self, key, item)
 
     def __getitem__(self, key):
-        value = self.header[key]
+        if key not in Packet.HEADER_FIELDS:
+            raise KeyError(key)
+
+        value = getattr(self, key)
 
         if value is None:
             raise ValueError("key = {} not in Packet {}".format(key, self))
@@ -85,37 +171,401 @@ class Packet(Base):
         return value
 
 
-def logthis(level):
-    def _decorator(fn):
-        def _decorated(*arg, **kwargs):
+class PacketPool:
+    """ Allocator recycling the packets that left the network """
+    def __init__(self, new_id, reuse=True):
+        # callable returning a fresh packet id
+        self.new_id = new_id
+        self.reuse = reuse
+        self.free = []
+
+        self.allocated = 0
+        self.recycled = 0
+
+    def new(self, size, src_ip, src_port, dst_ip, dst_port, tx_time):
+        if self.free:
+            packet = self.free.pop()
+            packet.reset(size, self.new_id())
+            self.recycled += 1
+        else:
+            packet = Packet(size, self.new_id())
+            self.allocated += 1
+
+        packet.src_ip = src_ip
+        packet.src_port = src_port
+        packet.dst_ip = dst_ip
+        packet.dst_port = dst_port
+        packet.tx_time = tx_time
+
+        return packet
+
+    def release(self, packet):
+        """ Give back a delivered or dropped packet """
+        if self.reuse:
+            self.free.append(packet)
+
+
+# kinds of the records of TraceRecorder; 0 marks a record not written yet
+TRACE_SENT = 1
+TRACE_QUEUED = 2
+TRACE_TRANSMITTED = 3
+TRACE_FORWARDED = 4
+TRACE_DELIVERED = 5
+TRACE_DROPPED = 6
+
+# why a packet was dropped, in the reason of TRACE_DROPPED records
+DROP_NONE = 0
+DROP_SELFISH = 1
+DROP_PENALTY = 2
+DROP_QUEUE = 3
+DROP_REASONS = {DROP_SELFISH: 'selfish',
+                DROP_PENALTY: 'penalty',
+                DROP_QUEUE: 'queue'}
+
+# one record of the binary trace: the event happened at node, src and dst
+# are the addresses of the flow of the packet and hop the links it crossed
+TRACE_DTYPE = np.dtype([
+    ('time', '<f8'),
+    ('packet', '<i8'),
+    ('src', '<i4'),
+    ('dst', '<i4'),
+    ('node', '<i4'),
+    ('size', '<i4'),
+    ('hop', '<u2'),
+    ('kind', 'u1'),
+    ('reason', 'u1'),
+])
+
+
+class TraceRecorder:
+    """ Binary trace of the packets, in a memory-mapped file of records.
+
+    Each call to record() appends a tuple to a list; every block_records
+    records the list is converted to TRACE_DTYPE and copied in the file at
+    once. The file is mapped with room for preallocate records and grown
+    by as many when full, then cut to the records written by close(). A
+    trace left by a crash has unused records (kind 0) at its end, which
+    TraceReader skips.
+
+    Only created when a trace is requested: the layers check
+    `sim.recorder is not None` before touching it.
+    """
+    def __init__(self, path, block_records=1 << 16, preallocate=1 << 22):
+        self.path = path
+        self.block_records = block_records
+        self.preallocate = max(preallocate, block_records)
+
+        self.pending = []
+        self.count = 0
+        self.records = None
+        with open(path, 'wb'):
+            pass
+        self._map(self.preallocate)
+
+    def _map(self, capacity):
+        if self.records is not None:
+            self.records.flush()
+            self.records = None
+        with open(self.path, 'r+b') as file:
+            file.truncate(capacity * TRACE_DTYPE.itemsize)
+        self.records = np.memmap(self.path, dtype=TRACE_DTYPE, mode='r+',
+                                 shape=(capacity,))
+
+    def record(self, time, kind, node, packet, reason=DROP_NONE):
+        self.pending.append((time, packet.id_, packet.src_ip, packet.dst_ip,
+                             node, packet.size, packet.hops, kind, reason))
+        if len(self.pending) >= self.block_records:
+            self.flush()
+
+    def flush(self):
+        """ Copy the pending records in the file """
+        if not self.pending:
+            return
+        block = np.array(self.pending, dtype=TRACE_DTYPE)
+        self.pending = []
+
+        end = self.count + len(block)
+        if end > len(self.records):
+            self._map(len(self.records) + max(self.preallocate, len(block)))
+        self.records[self.count:end] = block
+        self.count = end
+
+    def close(self):
+        """ Write the pending records and drop the unused room """
+        if self.records is None:
+            return
+        self.flush()
+        self.records.flush()
+        self.records = None
+        with open(self.path, 'r+b') as file:
+            file.truncate(self.count * TRACE_DTYPE.itemsize)
+
+    def __getstate__(self):
+        # the mapping is not picklable: a restored recorder is closed
+        # until reopen()
+        self.flush()
+        state = dict(self.__dict__)
+        state['records'] = None
+        return state
+
+    def reopen(self):
+        """ Go on appending to the file, after the records saved so far.
+
+        The records written after the state was saved are cleared, so
+        only a recorder whose original is gone (a crash) may reopen.
+        """
+        if os.path.exists(self.path):
+            self._map(max(self.count + self.preallocate,
+                          os.path.getsize(self.path) // TRACE_DTYPE.itemsize))
+            self.records[self.count:] = np.zeros(1, dtype=TRACE_DTYPE)
+
+
+def _reduce(keys, sums, maxima):
+    """ Sum and max of the columns over equal keys, by sorted key """
+    unique, inverse = np.unique(keys, return_inverse=True)
+    reduced = {name: np.bincount(inverse, weights=values,
+                                 minlength=len(unique))
+               for name, values in sums.items()}
+    for name, values in maxima.items():
+        reduced[name] = np.zeros(len(unique))
+        np.maximum.at(reduced[name], inverse, values)
+    return unique, reduced
+
+
+def _flow_key(records):
+    return (records['src'].astype(np.int64) << 32) | \
+        records['dst'].astype(np.int64)
+
+
+class TraceReader:
+    """ Statistics of a trace written by TraceRecorder.
+
+    The file is mapped read-only and walked chunk_records records at a
+    time: each chunk is reduced with vectorized operations to a few values
+    per flow or node, so only a chunk (and the send time of every packet,
+    to match its delivery) is in memory at once.
+    """
+    def __init__(self, path, chunk_records=1 << 22):
+        self.path = path
+        self.chunk_records = chunk_records
+        length = os.path.getsize(path) // TRACE_DTYPE.itemsize
+        if length:
+            self.records = np.memmap(path, dtype=TRACE_DTYPE, mode='r',
+                                     shape=(length,))
+        else:
+            self.records = np.zeros(0, dtype=TRACE_DTYPE)
+
+    def __len__(self):
+        return len(self.records)
+
+    def chunks(self):
+        """ The written records, in order, as arrays of TRACE_DTYPE """
+        for start in range(0, len(self.records), self.chunk_records):
+            chunk = np.asarray(self.records[start:start + self.chunk_records])
+            yield chunk[chunk['kind'] != 0]
+
+    def flows(self):
+        """ Columns of per-flow statistics, one row per (src, dst).
+
+        latency is the time from the creation of a packet to its delivery
+        and hops the links it crossed, both over the delivered packets;
+        the drops are split by reason.
+        """
+        send_time = np.zeros(0)
+        keys = []
+        parts = []
+        for chunk in self.chunks():
+            sent = chunk[chunk['kind'] == TRACE_SENT]
+            if len(sent):
+                top = int(sent['packet'].max()) + 1
+                if top > len(send_time):
+                    grown = np.zeros(max(top, 2 * len(send_time)))
+                    grown[:len(send_time)] = send_time
+                    send_time = grown
+                send_time[sent['packet']] = sent['time']
+
+            kind = chunk['kind']
+            chunk = chunk[(kind == TRACE_SENT) | (kind == TRACE_DELIVERED) |
+                          (kind == TRACE_DROPPED)]
+            kind = chunk['kind']
+            delivered = kind == TRACE_DELIVERED
+            latency = np.where(delivered,
+                               chunk['time'] - send_time[chunk['packet']], 0)
+            hops = np.where(delivered, chunk['hop'], 0)
+
+            sums = {
+                'sent': kind == TRACE_SENT,
+                'delivered': delivered,
+                'latency_sum': latency,
+                'hops_sum': hops,
+            }
+            for reason, name in DROP_REASONS.items():
+                sums['drops_' + name] = (kind == TRACE_DROPPED) & \
+                    (chunk['reason'] == reason)
+            key, reduced = _reduce(_flow_key(chunk), sums,
+                                   {'latency_max': latency, 'hops_max': hops})
+            keys.append(key)
+            parts.append(reduced)
+
+        if not parts:
+            return {}
+        names = parts[0].keys()
+        key, flows = _reduce(
+            np.concatenate(keys),
+            {name: np.concatenate([part[name] for part in parts])
+             for name in names if not name.endswith('_max')},
+            {name: np.concatenate([part[name] for part in parts])
+             for name in names if name.endswith('_max')})
+
+        delivered = np.maximum(flows['delivered'], 1)
+        columns = {
+            'src': key >> 32,
+            'dst': key & 0xffffffff,
+            'sent': flows['sent'].astype(np.int64),
+            'delivered': flows['delivered'].astype(np.int64),
+            'dropped': sum(flows['drops_' + name]
+                           for name in DROP_REASONS.values()).astype(np.int64),
+            'latency_mean': flows['latency_sum'] / delivered,
+            'latency_max': flows['latency_max'],
+            'hops_mean': flows['hops_sum'] / delivered,
+            'hops_max': flows['hops_max'].astype(np.int64),
+        }
+        for name in DROP_REASONS.values():
+            columns['drops_' + name] = flows['drops_' + name].astype(np.int64)
+        return columns
+
+    def drops(self):
+        """ Columns of the drops of each node, by reason """
+        keys = []
+        parts = []
+        for chunk in self.chunks():
+            dropped = chunk[chunk['kind'] == TRACE_DROPPED]
+            sums = {'drops_' + name: dropped['reason'] == reason
+                    for reason, name in DROP_REASONS.items()}
+            key, reduced = _reduce(dropped['node'], sums, {})
+            keys.append(key)
+            parts.append(reduced)
+
+        if not parts:
+            return {}
+        node, drops = _reduce(
+            np.concatenate(keys),
+            {name: np.concatenate([part[name] for part in parts])
+             for name in parts[0]},
+            {})
+        columns = {'node': node.astype(np.int64)}
+        for name, values in drops.items():
+            columns[name] = values.astype(np.int64)
+        return columns
+
+
+def _log_wrapper(fn, level):
+    def _decorated(*arg, **kwargs):
+        if not logger.isEnabledFor(level):
+            return fn(*arg, **kwargs)
+
+        # decorated functions are methods of layers: arg[0] is the layer
+        now = arg[0].sim.event_queue.now
+        logger.log(level,
+                   "[%f] %s: args=%r, kwargs=%r",
+                   now,
+                   fn.__name__,
+                   arg,
+                   kwargs)
+
+        ret = fn(*arg, **kwargs)
+        if ret:
             logger.log(level,
-                       "[%f] %s: args=%r, kwargs=%r",
-                       event_queue.now,
+                       """\t called %s: args=%r,
+                        kwargs=%r got return value: %r""",
                        fn.__name__,
                        arg,
-                       kwargs)
-
-            ret = fn(*arg, **kwargs)
-            if ret:
-                logger.log(level,
-                           """\t called %s: args=%r,
-                            kwargs=%r got return value: %r""",
-                           fn.__name__,
-                           arg,
-                           kwargs,
-                           ret)
-            return ret
-        return _decorated
+                       kwargs,
+                       ret)
+        return ret
+    _decorated.__name__ = fn.__name__
+    _decorated.__wrapped__ = fn
+    return _decorated
+
+
+class _LogThis:
+    """ Placeholder put in the class body by logthis.
+
+    When the class is created it registers the method and replaces itself
+    with the plain function, or with the logging wrapper if the logger is
+    already enabled for the level. instrument() repeats the choice later.
+    """
+    def __init__(self, fn, level):
+        self.fn = fn
+        self.level = level
+
+    def __set_name__(self, owner, name):
+        _instrumented.append((owner, name, self.fn, self.level))
+        _install(owner, name, self.fn, self.level)
+
+
+def _install(owner, name, fn, level):
+    if logger.isEnabledFor(level):
+        setattr(owner, name, _log_wrapper(fn, level))
+    else:
+        setattr(owner, name, fn)
+
+
+def logthis(level):
+    """ Log calls of a layer method, at no cost when logging is disabled """
+    def _decorator(fn):
+        return _LogThis(fn, level)
     return _decorator
 
 
-# create a logger for all interesting events
-logger = logging.getLogger("simulator")
+def instrument():
+    """ Wrap the logged methods only if the logger needs them.
+
+    Called whenever a Simulation is created, so the current level of the
+    logger is honoured.
+    """
+    for owner, name, fn, level in _instrumented:
+        _install(owner, name, fn, level)
+
 
-# create event queue
-event_queue = EventQueue()
+class _Traced:
+    """ Logged method of a single layer, appending its calls to sim.trace.
 
-# graph containing the whole topology
-G = nx.DiGraph()
+    The entries are (time, method, layer id, packet id) tuples. Installed
+    on the layers of the simulations created with trace=True only, so the
+    other simulations of the process call the plain methods.
+    """
+    def __init__(self, layer, name):
+        self.layer = layer
+        self.name = name
+        self.__name__ = name
+
+    def __call__(self, *args, **kwargs):
+        layer = self.layer
+        packet = args[0] if args else None
+        layer.sim.trace.append((layer.sim.event_queue.now,
+                                self.name,
+                                layer.id_,
+                                getattr(packet, 'id_', None)))
+        # the method of the class, with the logging wrapper if enabled
+        return getattr(type(layer), self.name)(layer, *args, **kwargs)
+
+    def __reduce__(self):
+        return _Traced, (self.layer, self.name)
+
+
+def trace_layer(layer):
+    """ Record the calls of the logged methods of layer in its sim.trace """
+    for owner, name, _, _ in _instrumented:
+        if isinstance(layer, owner):
+            setattr(layer, name, _Traced(layer, name))
+
+
+# methods decorated by logthis: (class, name, function, level)
+_instrumented = []
+
+
+# create a logger for all interesting events
+logger = logging.getLogger("simulator")
 
 DEFAULT_WEIGHT = 10
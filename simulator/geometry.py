@@ -0,0 +1,88 @@
+import hashlib
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+from .util import atomic_write
+
+
+class GeometryCache:
+    """ Arrays describing the geometry of a scenario, built once per key.
+
+    The positions of the nodes and the links between them only depend on
+    the topological parameters of a scenario (dim, node_num, dist_lim,
+    seed, ...), not on the rates and limits swept over them: a geometry is
+    built the first time its key is asked, then served from memory (the
+    last max_entries keys) or from cache_dir, one .npz file per key, which
+    several processes can share. version is mixed in the key of the files,
+    so that a change of the code building them invalidates the directory.
+    """
+    def __init__(self, cache_dir=None, max_entries=256, version=''):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.configure(cache_dir, version)
+
+    def configure(self, cache_dir=None, version=''):
+        self.cache_dir = cache_dir
+        self.version = version
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def clear(self):
+        """ Forget the geometries in memory, the files are kept """
+        self.entries.clear()
+
+    def path(self, key):
+        digest = hashlib.sha256(
+            (self.version + repr(key)).encode()).hexdigest()
+        return os.path.join(self.cache_dir, digest[:2], digest + '.npz')
+
+    def _load(self, key):
+        if self.cache_dir is None:
+            return None
+        try:
+            with np.load(self.path(key)) as data:
+                return {name: data[name] for name in data.files}
+        except (OSError, ValueError, EOFError):
+            return None
+
+    def _store(self, key, geometry):
+        if self.cache_dir is None:
+            return
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with atomic_write(path) as file:
+            np.savez(file, **geometry)
+
+    def get(self, key, build):
+        """ Geometry of key, calling build() to create it when missing """
+        geometry = self.entries.get(key)
+        if geometry is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return geometry
+
+        geometry = self._load(key)
+        if geometry is None:
+            self.misses += 1
+            geometry = build()
+            self._store(key, geometry)
+        else:
+            self.hits += 1
+
+        self.entries[key] = geometry
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return geometry
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'geometry_hits': self.hits,
+            'geometry_misses': self.misses,
+            'geometry_hit_rate': self.hits / lookups if lookups else 0,
+        }
@@ -1,37 +1,34 @@
 import logging
+from collections import deque
 # from math import sqrt
 # from random import random
 
-from numpy.random import geometric
 # from scipy.constants import Boltzmann, pi
 # from scipy.special import erfc
-import networkx as nx
-from .core import G, event_queue, Base, logthis, DEFAULT_WEIGHT, Event, Packet
+from .core import Base, logthis, DEFAULT_WEIGHT, Event
+from .core import (TRACE_SENT, TRACE_QUEUED, TRACE_TRANSMITTED,
+                   TRACE_FORWARDED, TRACE_DELIVERED, TRACE_DROPPED,
+                   DROP_SELFISH, DROP_PENALTY, DROP_QUEUE)
 
 
 class Layer(Base):
-    # static class variables
-    last_layer_id = 0
-    all_layers = {}
+    def __init__(self, sim):
+        # simulation owning the layer
+        self.sim = sim
 
-    def __init__(self):
-        # set unique id
-        Layer.last_layer_id += 1
-        self.id_ = Layer.last_layer_id
-
-        # store in a dict all Layers created, in order to look them up by id
-        Layer.all_layers[self.id_] = self
+        # set unique id, registering the layer to be looked up by id
+        self.id_ = sim.register(self)
 
     @logthis(logging.DEBUG)
     def send_up(self, packet, upper_layer_id):
         # event is immediate, fire it now without passing through event queue
-        upper_layer = Layer.all_layers[upper_layer_id]
+        upper_layer = self.sim.layers[upper_layer_id]
         upper_layer.recv_from_down(packet, self.id_)
 
     @logthis(logging.DEBUG)
     def send_down(self, packet, lower_layer_id):
         # event is immediate, fire it now without passing through event queue
-        lower_layer = Layer.all_layers[lower_layer_id]
+        lower_layer = self.sim.layers[lower_layer_id]
         lower_layer.recv_from_up(packet, self.id_)
 
     def recv_from_up(self, packet, upper_layer_id):
@@ -42,8 +39,8 @@ class Layer(Base):
 
 
 class Channel(Layer):
-    def __init__(self, p_succ, rtt, src_ip, dst_ip, dst_id):
-        super(self.__class__, self).__init__()
+    def __init__(self, sim, p_succ, rtt, src_ip, dst_ip, dst_id):
+        super(self.__class__, self).__init__(sim)
 
         self.p_succ = p_succ
         self.rtt = rtt
@@ -53,20 +50,66 @@ class Channel(Layer):
         self.dst_ip = dst_ip
 
         # register channel as edge in graph
-        G.add_edge(src_ip, dst_ip)
-        G[src_ip][dst_ip]['weight'] = DEFAULT_WEIGHT
+        sim.topology.add_edge(src_ip, dst_ip, DEFAULT_WEIGHT)
 
         # id of destination
         self.dst_id = dst_id
 
-        self.queue = []
+        # number of attempts needed by each transmission
+        self.tx_attempts = sim.streams.geometric(('channel', src_ip, dst_ip),
+                                                 p_succ)
+
+        # packets waiting, with the time they entered the queue
+        self.queue = deque()
+        # at most queue_limit packets wait, the others are dropped (tail
+        # drop); each service event transmits up to burst packets
+        self.queue_limit = sim.queue_limit
+        self.burst = sim.burst
+        self.lifo = sim.channel_lifo
 
         # record how much data have passed ~> bitrate
         self.tx_size = 0
 
+        # statistics of the queue
+        self.tx_packets = 0
+        self.dropped = 0
+        self.services = 0
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+        self.occupancy_max = 0
+        # integral of the queue length over time, up to occupancy_time
+        self.occupancy_area = 0.0
+        self.occupancy_time = sim.event_queue.now
+
+    def _occupancy(self, now):
+        """ Account the queue length since the last change """
+        self.occupancy_area += len(self.queue) * (now - self.occupancy_time)
+        self.occupancy_time = now
+
     def recv_from_up(self, packet, upper_layer_id):
+        if self.queue_limit is not None and \
+           len(self.queue) >= self.queue_limit:
+            # buffer full: drop the newcomer
+            self.dropped += 1
+            if self.sim.profile is not None:
+                self.sim.profile.drops_queue += 1
+            if self.sim.recorder is not None:
+                self.sim.recorder.record(self.sim.event_queue.now,
+                                         TRACE_DROPPED, self.src_ip, packet,
+                                         DROP_QUEUE)
+            self.sim.packets.release(packet)
+            return
+
         # add packet to the queue
-        self.queue.append(packet)
+        now = self.sim.event_queue.now
+        if self.sim.recorder is not None:
+            self.sim.recorder.record(now, TRACE_QUEUED, self.src_ip, packet)
+        self._occupancy(now)
+        self.queue.append((now, packet))
+        if len(self.queue) > self.occupancy_max:
+            self.occupancy_max = len(self.queue)
+        if self.sim.profile is not None:
+            self.sim.profile.queue_depth(self.id_, len(self.queue))
 
         # if it is the first in the queue, schedule its reception at dst_id
         if len(self.queue) == 1:
@@ -74,37 +117,74 @@ class Channel(Layer):
 
     def schedule_tx(self):
         """ Add the next transmission to the event queue """
-        tx_time = geometric(self.p_succ) * self.rtt
+        event_queue = self.sim.event_queue
+        tx_time = next(self.tx_attempts) * self.rtt
         event_queue.add(Event(action=self.transmit,
                               when=event_queue.now + tx_time))
 
     def transmit(self):
-        """ Transmit the next packet waiting """
+        """ Transmit the next packets waiting, up to burst of them """
         assert len(self.queue) > 0, 'Empty queue while tx in {}'.format(self)
 
-        pkt = self.queue.pop()
-
-        # send the packet to destination
-        self.send_up(pkt, upper_layer_id=self.dst_id)
+        now = self.sim.event_queue.now
+        self._occupancy(now)
+        self.services += 1
 
-        # update weight in graph with inverse of bitrate
-        self.tx_size += pkt.size
-        G[self.src_ip][self.dst_ip]['weight'] = event_queue.now / self.tx_size
+        for _ in range(min(self.burst, len(self.queue))):
+            if self.lifo:
+                queued, pkt = self.queue.pop()
+            else:
+                queued, pkt = self.queue.popleft()
+            self.tx_size += pkt.size
+            pkt.hops += 1
+            if self.sim.recorder is not None:
+                self.sim.recorder.record(now, TRACE_TRANSMITTED, self.src_ip,
+                                         pkt)
+
+            latency = now - queued
+            self.tx_packets += 1
+            self.latency_sum += latency
+            if latency > self.latency_max:
+                self.latency_max = latency
+
+            # send the packet to destination
+            self.send_up(pkt, upper_layer_id=self.dst_id)
+
+            # update weight in graph with inverse of bitrate
+            self.sim.route_cache.set_edge_weight(
+                self.src_ip, self.dst_ip, now / self.tx_size)
 
         # schedule the next transmission, if queue is not empty
         if len(self.queue) > 0:
             self.schedule_tx()
 
+    def stats(self):
+        """ Latency and occupancy of the queue, up to the current time """
+        # the time of the queue is reset when the simulation stops
+        now = max(self.sim.event_queue.now, self.occupancy_time)
+        self._occupancy(now)
+        return {
+            'tx_packets': self.tx_packets,
+            'dropped': self.dropped,
+            'services': self.services,
+            'latency_mean':
+                self.latency_sum / self.tx_packets if self.tx_packets else 0,
+            'latency_max': self.latency_max,
+            'occupancy_mean': self.occupancy_area / now if now else 0,
+            'occupancy_max': self.occupancy_max,
+        }
 
-class BatmanLayer(Layer):
-    drop_lim = 10
 
-    def __init__(self, local_ip, selfish, position):
-        super(self.__class__, self).__init__()
+class BatmanLayer(Layer):
+    def __init__(self, sim, local_ip, selfish, position):
+        super(self.__class__, self).__init__(sim)
 
-        # flag to discriminate between normal and selfish node
+        # flag to discriminate between normal and selfish node, and drop
+        # score, both stored in the strategy arrays at index _idx
         # NOTE a selfish node does not forward packets from others
-        self.selfish = selfish
+        selfish = bool(selfish)
+        sim.metrics.add_node(local_ip, selfish)
+        self._idx = sim.strategy.add_node(local_ip, selfish)
         self.position = position
         self.neighbour_table = {
             # dest IP: ID of channel layer
@@ -113,28 +193,45 @@ class BatmanLayer(Layer):
             # local port: ID of app_layer
         }
 
-        self.drop_score = 0
-
         # routing address of node
         self.local_ip = local_ip
 
         # register in graph
-        G.add_node(local_ip,
-                   selfish=int(selfish),
-                   x=position[0],
-                   y=position[1],
-                   weight=self.drop_score)
+        sim.topology.add_node(local_ip,
+                              selfish=selfish,
+                              x=position[0],
+                              y=position[1],
+                              weight=self.drop_score)
+
+    @property
+    def selfish(self):
+        return bool(self.sim.strategy.selfish[self._idx])
+
+    @selfish.setter
+    def selfish(self, selfish):
+        # keeps the running totals of selfish and altruistic nodes in sync
+        self.sim.strategy.set_selfish(self._idx, bool(selfish))
+
+    @property
+    def drop_score(self):
+        return int(self.sim.strategy.drop_score[self._idx])
+
+    @drop_score.setter
+    def drop_score(self, drop_score):
+        self.sim.strategy.drop_score[self._idx] = drop_score
 
     def connect_to(self, other, **kwargs):
         """ Connect self with other node through Channel objects """
 
         # create two symmetric channels for the two directions
-        c1 = Channel(**kwargs,
+        c1 = Channel(self.sim,
+                     **kwargs,
                      dst_id=other.id_,
                      src_ip=self.local_ip,
                      dst_ip=other.local_ip)
 
         self.neighbour_table[other.local_ip] = c1.id_
+        self.sim.strategy.add_link(self.local_ip, other.local_ip)
 
     def connect_app(self, app_layer):
         # save information about upper layer
@@ -142,58 +239,78 @@ class BatmanLayer(Layer):
 
         # register self in application layer
         app_layer.lower_layer_id = self.id_
+        self.sim.metrics.add_app(self.local_ip)
 
     def recv_from_up(self, packet, upper_layer_id):
-        def weight_edge(u, v, d):
-            # avoid double counting of node weight in the path
-            w_u = G.nodes[u]['weight'] / 2
-            w_v = G.nodes[v]['weight'] / 2
-            w_d = d.get('weight', 10)
-
-            return w_u + w_v + w_d
+        path = self.sim.route_cache.path(self.local_ip, packet.dst_ip)
 
-        path = nx.dijkstra_path(G, self.local_ip, packet['dst_ip'],
-                                weight=weight_edge)
-
-        packet['path'] = path[1:]
+        packet.path = path[1:]
         self.send_down(packet,
-                       self.neighbour_table[packet['path'][0]])
+                       self.neighbour_table[packet.path[0]])
 
     def recv_from_down(self, packet, lower_layer_id):
         # TODO use packet['next_hop_ip'] to perform routing
         # (and distinguish between next hop and destination ip)
-        if packet['path'][-1] == self.local_ip:  # handle packet for me
-            assert packet['dst_port'] in self.app_table
-
-            upper_layer_id = self.app_table[packet['dst_port']]
+        if packet.path[-1] == self.local_ip:  # handle packet for me
+            assert packet.dst_port in self.app_table
+
+            upper_layer_id = self.app_table[packet.dst_port]
+            if self.sim.profile is not None:
+                self.sim.profile.packets_delivered += 1
+            if self.sim.recorder is not None:
+                self.sim.recorder.record(self.sim.event_queue.now,
+                                         TRACE_DELIVERED, self.local_ip,
+                                         packet)
             self.send_up(packet, upper_layer_id)
         else:
             # penalize selfish nodes, dropping their packets
-            if G.nodes[packet['src_ip']]['weight'] > BatmanLayer.drop_lim:
+            src_weight = self.sim.topology.node_weight(packet.src_ip)
+            if src_weight > self.sim.drop_lim:
+                if self.sim.profile is not None:
+                    self.sim.profile.drops_penalty += 1
+                if self.sim.recorder is not None:
+                    self.sim.recorder.record(self.sim.event_queue.now,
+                                             TRACE_DROPPED, self.local_ip,
+                                             packet, DROP_PENALTY)
+                self.sim.packets.release(packet)
                 return
 
             if self.selfish is False:
-                packet['path'] = packet['path'][1:]
+                packet.path = packet.path[1:]
 
                 # give a prize to fair nodes
-                self.drop_score -= 1
-                if self.drop_score <= 0:
-                    self.drop_score = 0
-
-                self.send_down(packet, self.neighbour_table[packet['path'][0]])
+                drop_score = self.drop_score - 1
+                if drop_score <= 0:
+                    drop_score = 0
+                self.drop_score = drop_score
+
+                if self.sim.profile is not None:
+                    self.sim.profile.packets_forwarded += 1
+                if self.sim.recorder is not None:
+                    self.sim.recorder.record(self.sim.event_queue.now,
+                                             TRACE_FORWARDED, self.local_ip,
+                                             packet)
+                self.send_down(packet, self.neighbour_table[packet.path[0]])
             else:
                 # penalize node if packet is dropped
                 self.drop_score += 1
+                if self.sim.profile is not None:
+                    self.sim.profile.drops_selfish += 1
+                if self.sim.recorder is not None:
+                    self.sim.recorder.record(self.sim.event_queue.now,
+                                             TRACE_DROPPED, self.local_ip,
+                                             packet, DROP_SELFISH)
+                self.sim.packets.release(packet)
 
         # keep graph in sync
-        G.nodes[self.local_ip]['weight'] = self.drop_score
+        self.sim.route_cache.set_node_weight(self.local_ip, self.drop_score)
 
 
 class ApplicationLayer(Layer):
-    def __init__(self, interarrival_gen, size_gen, start_time, stop_time,
-                 local_port, local_ip, dst_port, dst_ip):
+    def __init__(self, sim, interarrival_gen, size_gen, start_time,
+                 stop_time, local_port, local_ip, dst_port, dst_ip):
 
-        super(self.__class__, self).__init__()
+        super(self.__class__, self).__init__(sim)
 
         # save address details
         self.local_port = local_port
@@ -216,38 +333,45 @@ class ApplicationLayer(Layer):
         self.tx_packet_size = 0
 
         # schedule start of transmissions
-        event_queue.add(
-            Event(action=lambda: self.generate_pkts(), when=start_time)
-            )
+        sim.event_queue.add(Event(action=self.generate_pkts, when=start_time))
 
     @logthis(logging.DEBUG)
     def generate_pkts(self):
+        event_queue = self.sim.event_queue
         size = next(self.size_gen)
         time_delta = next(self.interarrival_gen)
         next_gen_time = time_delta + event_queue.now
 
         if next_gen_time < self.stop_time:
             # send packet to lower layer
-            p = Packet(size=size,
-                       header={
-                           'src_ip':   self.local_ip,
-                           'src_port': self.local_port,
-                           'dst_ip':   self.dst_ip,
-                           'dst_port': self.dst_port,
-                           'tx_time': event_queue.now
-                       })
+            p = self.sim.packets.new(size=size,
+                                     src_ip=self.local_ip,
+                                     src_port=self.local_port,
+                                     dst_ip=self.dst_ip,
+                                     dst_port=self.dst_port,
+                                     tx_time=event_queue.now)
 
             self.tx_packet_count += 1
             self.tx_packet_size += p.size
+            self.sim.metrics.app_tx(self.local_ip, p.size)
+            if self.sim.profile is not None:
+                self.sim.profile.packets_sent += 1
+            if self.sim.recorder is not None:
+                self.sim.recorder.record(event_queue.now, TRACE_SENT,
+                                         self.local_ip, p)
             self.send_down(p, lower_layer_id=self.lower_layer_id)
 
             # call function again after interarrival
             event_queue.add(Event(self.generate_pkts, when=next_gen_time))
 
     def recv_from_down(self, packet, lower_layer_id):
-        if packet['dst_port'] == self.local_port and \
-           packet['src_port'] == self.dst_port:
+        if packet.dst_port == self.local_port and \
+           packet.src_port == self.dst_port:
 
             # increment count if packet is for this layer
             self.rx_packet_count += 1
             self.rx_packet_size += packet.size
+            self.sim.metrics.app_rx(self.local_ip, packet.size)
+
+        # the packet reached its destination: it can be recycled
+        self.sim.packets.release(packet)
@@ -0,0 +1,256 @@
+from collections import deque
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+
+from .core import DEFAULT_WEIGHT
+from .topology import ArrayTopology
+
+
+class MeanField:
+    """ Fluid approximation of the selfishness game, without packets.
+
+    Every flow (the traffic of an app towards its peer) sends its expected
+    bytes in steps of snapshot_time / substeps, along the shortest path at
+    the start of the step, with the costs of the discrete simulation: half
+    the drop score of the end nodes plus the inverse bitrate of the link.
+    As in BatmanLayer.recv_from_down, the first relay drops the flows of a
+    node whose drop score is over drop_lim; otherwise the first selfish
+    relay drops the flow, gaining one point of drop score per packet, and
+    the relays before it lose one point per packet. Drop scores are the
+    expected ones, so they are not integers.
+
+    The strategy moves all the nodes at once every update_time, as
+    StrategyEngine.step does; the snapshots have the totals of
+    MetricsCollector.snapshot, from the bytes sent and received by every
+    node, and stop on the same variation test as new_snapshot.
+
+    flow_src and flow_dst are the nodes of every app and of its peer. An
+    app sends a packet at time 0, then one after every interarrival time,
+    uniform in interarrival = (low, high), until stop_time; size is the
+    mean size of the packets. The expected packets sent by an app in
+    every bin of resolution (a tenth of a step by default) follow from the
+    renewal of the packets of the previous bins.
+    """
+    def __init__(self, selfish, link_src, link_dst, flow_src, flow_dst,
+                 strategy, drop_lim, interarrival, size, stop_time,
+                 snapshot_time, update_time, thres_var, history=10,
+                 substeps=1, resolution=None):
+        self.selfish = np.array(selfish, dtype=bool)
+        self.drop_score = np.zeros(len(self.selfish))
+        self.link_src = np.asarray(link_src, dtype=np.int64)
+        self.link_dst = np.asarray(link_dst, dtype=np.int64)
+        self.flow_src = np.asarray(flow_src, dtype=np.int64)
+        self.flow_dst = np.asarray(flow_dst, dtype=np.int64)
+
+        self.strategy = strategy
+        self.drop_lim = drop_lim
+        self.size = size
+        self.stop_time = stop_time
+        self.snapshot_time = snapshot_time
+        self.update_time = update_time
+        self.thres_var = thres_var
+        self.substeps = substeps
+
+        n = len(self.selfish)
+        self.topology = ArrayTopology()
+        for idx in range(n):
+            self.topology.add_node(idx, False, 0, 0, 0)
+        for src, dst in zip(self.link_src.tolist(), self.link_dst.tolist()):
+            self.topology.add_edge(src, dst)
+
+        # links by key src * n + dst, to find the links along the paths
+        self._link_keys = self.link_src * n + self.link_dst
+        self._link_order = np.argsort(self._link_keys)
+        self.link_bytes = np.zeros(len(self.link_src))
+
+        self.adjacency = csr_matrix(
+            (np.ones(len(self.link_src), dtype=np.int64),
+             (self.link_src, self.link_dst)), shape=(n, n))
+        self.n_neigh = np.diff(self.adjacency.indptr)
+
+        # apps of every node, and the bytes they sent and received so far
+        self.apps = np.bincount(self.flow_src, minlength=n)
+        self.node_tx = np.zeros(n)
+        self.node_rx = np.zeros(n)
+
+        # expected packets sent by an app in each bin, as they are known:
+        # the packets of a bin schedule the next ones spread over the bins
+        # from low to high after it
+        self.resolution = resolution or snapshot_time / substeps / 10
+        low, high = interarrival
+        self._spread = (int(round(low / self.resolution)),
+                        max(int(round(high / self.resolution)), 1))
+        self._arrivals = np.zeros(self._spread[1] + 1)
+        self._bin = 0
+
+        self.now = 0.0
+        self.history = deque(maxlen=history)
+        self.args = {}
+        self.snapshots = []
+
+    def _links(self, src, dst):
+        """ Indices of the links src -> dst """
+        keys = src * len(self.selfish) + dst
+        pos = np.searchsorted(self._link_keys, keys, sorter=self._link_order)
+        return self._link_order[pos]
+
+    def _paths(self):
+        """ Nodes of the path of every flow, from its source, -1 padded.
+
+        Also returns the number of nodes of each path, 0 for the flows
+        without one.
+        """
+        n_links = len(self.link_src)
+        self.topology.node_w[:len(self.selfish)] = self.drop_score
+        self.topology.edge_w[:n_links] = np.where(
+            self.link_bytes > 0,
+            self.now / np.maximum(self.link_bytes, 1), DEFAULT_WEIGHT)
+
+        sources, row = np.unique(self.flow_src, return_inverse=True)
+        _, pred = dijkstra(self.topology.matrix(), directed=True,
+                           indices=sources, return_predecessors=True)
+
+        # walk back from the destinations, all the flows at once
+        steps = [self.flow_dst]
+        node = self.flow_dst
+        while True:
+            active = (node >= 0) & (node != self.flow_src)
+            if not active.any():
+                break
+            node = np.where(active, pred[row, np.maximum(node, 0)], -1)
+            steps.append(np.where(node >= 0, node, -1))
+        steps = np.column_stack(steps)
+
+        length = (steps >= 0).sum(axis=1)
+        reached = steps[np.arange(len(steps)), length - 1] == self.flow_src
+        length = np.where(reached, length, 0)
+
+        # reverse the valid part of every row
+        pos = length[:, None] - 1 - np.arange(steps.shape[1])
+        paths = np.where(pos >= 0,
+                         np.take_along_axis(steps, np.maximum(pos, 0), 1), -1)
+        return paths, length
+
+    def send(self, packets):
+        """ Send packets per app along the current paths """
+        n = len(self.selfish)
+        n_bytes = packets * self.size
+        self.node_tx += self.apps * n_bytes
+
+        paths, length = self._paths()
+        flows = np.arange(len(paths))
+        n_relays = np.maximum(length - 2, 0)
+        relays = paths[:, 1:-1]
+        column = np.arange(relays.shape[1])
+        valid = column < n_relays[:, None]
+
+        # the first relay drops the flows of penalised nodes, otherwise the
+        # first selfish relay does
+        selfish_relay = valid & self.selfish[np.maximum(relays, 0)]
+        first = np.where(selfish_relay.any(axis=1),
+                         selfish_relay.argmax(axis=1), n_relays)
+        penalised = (self.drop_score[self.flow_src] > self.drop_lim) & \
+            (n_relays > 0)
+        first = np.where(penalised, 0, first)
+        dropped = first < n_relays
+        delivered = (length > 0) & ~dropped
+
+        forwarders = relays[valid & (column < first[:, None]) &
+                            ~penalised[:, None]]
+        droppers = relays[flows[dropped & ~penalised],
+                          first[dropped & ~penalised]]
+        self.drop_score += packets * (np.bincount(droppers, minlength=n) -
+                                      np.bincount(forwarders, minlength=n))
+        np.maximum(self.drop_score, 0, out=self.drop_score)
+
+        self.node_rx += np.bincount(self.flow_dst[delivered],
+                                    minlength=n) * n_bytes
+
+        # links crossed, up to the relay dropping the flow
+        crossed = np.where(dropped, first + 1, np.maximum(length - 1, 0))
+        for hop in range(paths.shape[1] - 1):
+            on_link = hop < crossed
+            links = self._links(paths[on_link, hop], paths[on_link, hop + 1])
+            self.link_bytes += n_bytes * np.bincount(
+                links, minlength=len(self.link_src))
+
+    def _schedule(self, packets, after):
+        """ Schedule the packets following the ones sent in bin after """
+        low, high = self._spread
+        start = after + 1 + low
+        end = after + 1 + max(high, low + 1)
+        if end > len(self._arrivals):
+            grown = np.zeros(max(end, 2 * len(self._arrivals)))
+            grown[:len(self._arrivals)] = self._arrivals
+            self._arrivals = grown
+        self._arrivals[start:end] += packets / (end - start)
+
+    def advance(self, until):
+        """ Send the traffic of the apps up to until """
+        packets = 0.0
+        last = int(round(min(until, self.stop_time) / self.resolution))
+        while self._bin < last:
+            sent = self._arrivals[self._bin]
+            packets += sent
+            self._schedule(sent, self._bin)
+            self._bin += 1
+        if packets > 0:
+            self.send(packets)
+        self.now = until
+
+    def update(self):
+        """ Strategy update of all the nodes """
+        selfish_neigh = self.adjacency.dot(self.selfish.astype(np.int64))
+        self.selfish = np.asarray(self.strategy(
+            self.selfish, self.drop_score, selfish_neigh, self.n_neigh,
+            self.drop_lim), dtype=bool)
+
+    def snapshot(self):
+        """ Current totals, with the keys of the snapshot dicts """
+        selfish = self.selfish
+        return {
+            'altruistic_tx': int(round(self.node_tx[~selfish].sum())),
+            'altruistic_rx': int(round(self.node_rx[~selfish].sum())),
+            'selfish_tx': int(round(self.node_tx[selfish].sum())),
+            'selfish_rx': int(round(self.node_rx[selfish].sum())),
+            'selfish_num': int(self.apps[selfish].sum()),
+            'altruistic_num': int(self.apps[~selfish].sum()),
+        }
+
+    def _snapshot(self):
+        """ Record a snapshot, return whether the game is still moving """
+        totals = self.snapshot()
+        self.snapshots.append({'time': self.now, **self.args, **totals})
+
+        # mean change over the history, like MetricsCollector.variation
+        diff = sum(abs(totals['selfish_num'] - prev)
+                   for prev in self.history) / self.history.maxlen
+        self.history.append(totals['selfish_num'])
+        return diff > self.thres_var
+
+    def run(self, until=None):
+        """ Run until the snapshots are stable, or up to until """
+        dt = self.snapshot_time / self.substeps
+        # the first packet of every app leaves at time 0
+        self.send(1)
+        self._schedule(1, -1)
+
+        tick = 0
+        next_update = self.update_time
+        while True:
+            tick += 1
+            now = tick * dt
+            if until is not None and now > until:
+                break
+            self.advance(now)
+
+            # updates before snapshots at the same time, as in the queue
+            while next_update <= now + dt / 2:
+                self.update()
+                next_update += self.update_time
+            if tick % self.substeps == 0 and not self._snapshot():
+                break
+
+        return self.snapshots
@@ -0,0 +1,77 @@
+from collections import deque
+
+
+class MetricsCollector:
+    """ Running totals of the traffic of selfish and altruistic nodes.
+
+    Applications report every packet sent and received and nodes report
+    every change of strategy, so the totals over all the nodes are always
+    up to date and a snapshot costs O(1) instead of a walk over all the
+    layers. The totals of a node move to the other group when it flips.
+    """
+    def __init__(self, history=10):
+        self.selfish = {
+            # node ip: current strategy
+        }
+        self.node_tx = {}
+        self.node_rx = {}
+        self.node_apps = {}
+
+        # totals indexed by strategy: False is altruistic, True selfish
+        self.tx = {False: 0, True: 0}
+        self.rx = {False: 0, True: 0}
+        self.apps = {False: 0, True: 0}
+
+        # number of selfish apps in the last snapshots
+        self.history = deque(maxlen=history)
+
+    def add_node(self, ip, selfish):
+        self.selfish[ip] = bool(selfish)
+        self.node_tx[ip] = 0
+        self.node_rx[ip] = 0
+        self.node_apps[ip] = 0
+
+    def add_app(self, ip):
+        self.node_apps[ip] += 1
+        self.apps[self.selfish[ip]] += 1
+
+    def set_selfish(self, ip, selfish):
+        old = self.selfish[ip]
+        selfish = bool(selfish)
+        if old == selfish:
+            return
+
+        self.selfish[ip] = selfish
+        for totals, node_totals in ((self.tx, self.node_tx),
+                                    (self.rx, self.node_rx),
+                                    (self.apps, self.node_apps)):
+            totals[old] -= node_totals[ip]
+            totals[selfish] += node_totals[ip]
+
+    def app_tx(self, ip, size):
+        self.node_tx[ip] += size
+        self.tx[self.selfish[ip]] += size
+
+    def app_rx(self, ip, size):
+        self.node_rx[ip] += size
+        self.rx[self.selfish[ip]] += size
+
+    def snapshot(self):
+        """ Current totals, with the keys of the snapshot dicts """
+        return {
+            'altruistic_tx': self.tx[False],
+            'altruistic_rx': self.rx[False],
+            'selfish_tx': self.tx[True],
+            'selfish_rx': self.rx[True],
+            'selfish_num': self.apps[True],
+            'altruistic_num': self.apps[False]
+        }
+
+    def variation(self, selfish_num):
+        """ Mean change of selfish_num over the history, then record it """
+        diff = 0
+        for prev in self.history:
+            diff += abs(selfish_num - prev)
+        self.history.append(selfish_num)
+
+        return diff / self.history.maxlen
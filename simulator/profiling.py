@@ -0,0 +1,91 @@
+import time
+from collections import Counter
+
+
+def action_name(action):
+    """ Name of the function behind an event action """
+    function = getattr(action, 'func', action)  # unwrap partial
+    return getattr(function, '__name__', type(function).__name__)
+
+
+class Profile:
+    """ Counters of where a simulation spends its time.
+
+    Only created when profiling is requested: the layers check
+    `sim.profile is not None` before touching it, so a simulation without
+    profile pays a single attribute lookup on each hot path.
+    """
+    # actions of the events counted in a column of their own
+    ACTIONS = ('generate_pkts', 'transmit', 'new_snapshot',
+               'update_selfishness')
+
+    def __init__(self):
+        self.events = Counter()
+
+        self.packets_sent = 0
+        self.packets_forwarded = 0
+        self.packets_delivered = 0
+        self.drops_selfish = 0
+        self.drops_penalty = 0
+        self.drops_queue = 0
+
+        self.dijkstra_calls = 0
+        self.dijkstra_time = 0.0
+
+        self.queue_high_water = {
+            # channel id: longest queue seen
+        }
+
+        self.wall_time = 0.0
+        self.sim_time = 0.0
+
+    def queue_depth(self, channel_id, depth):
+        if depth > self.queue_high_water.get(channel_id, 0):
+            self.queue_high_water[channel_id] = depth
+
+    def summary(self):
+        """ Flat dict of the counters, one row per run """
+        high_water = list(self.queue_high_water.values())
+        row = {
+            'packets_sent': self.packets_sent,
+            'packets_forwarded': self.packets_forwarded,
+            'packets_delivered': self.packets_delivered,
+            'drops_selfish': self.drops_selfish,
+            'drops_penalty': self.drops_penalty,
+            'drops_queue': self.drops_queue,
+            'dijkstra_calls': self.dijkstra_calls,
+            'dijkstra_time': self.dijkstra_time,
+            'queue_high_water_max': max(high_water, default=0),
+            'queue_high_water_mean':
+                sum(high_water) / len(high_water) if high_water else 0,
+            'wall_time': self.wall_time,
+            'sim_time': self.sim_time,
+            'wall_per_sim_second':
+                self.wall_time / self.sim_time if self.sim_time else 0,
+            'events': sum(self.events.values()),
+        }
+        # the same columns for every run, whatever the events that fired
+        for name in self.ACTIONS:
+            row['events_' + name] = self.events.get(name, 0)
+        row['events_other'] = row['events'] - sum(
+            self.events.get(name, 0) for name in self.ACTIONS)
+        return row
+
+    def run(self, sim, until=None):
+        """ Run sim like Simulation.run, counting the events by action """
+        event_queue = sim.event_queue
+        events = self.events
+        start = time.perf_counter()
+        # the last event may clean the queue, resetting its time
+        start_time = last_time = event_queue.now
+
+        while True:
+            when = event_queue.next_time()
+            if when is None or (until is not None and when > until):
+                break
+            event = event_queue.next()
+            events[action_name(event.action)] += 1
+            last_time = when
+
+        self.wall_time += time.perf_counter() - start
+        self.sim_time += last_time - start_time
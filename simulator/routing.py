@@ -0,0 +1,96 @@
+import time
+
+from .topology import NxTopology
+
+
+class RouteCache:
+    """ Routing table of dijkstra paths, keyed by (source, destination).
+
+    All the weight updates of the topology pass through set_node_weight and
+    set_edge_weight: the table is flushed as soon as one weight moves more
+    than `tolerance` away from its value at the last flush. With the default
+    tolerance of 0 every change flushes, so the paths are exactly the ones
+    computed on the current graph.
+
+    If `refresh_interval` is set, a path is recomputed when it is older
+    than that (simulated) time, like B.A.T.M.A.N. does with OGM intervals.
+    """
+    def __init__(self, event_queue, topology=None, tolerance=0,
+                 refresh_interval=None):
+        # the queue provides the current time, for the refresh interval
+        self.event_queue = event_queue
+        # profiling counters, set by the simulation when requested
+        self.profile = None
+        self.configure(topology, tolerance, refresh_interval)
+
+    def clean(self):
+        self.paths = {
+            # (src, dst): (path, time of computation)
+        }
+        # weights at the time of the last flush, filled in lazily
+        self.ref_weights = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.flushes = 0
+
+    def configure(self, topology=None, tolerance=0, refresh_interval=None):
+        self.topology = topology if topology is not None else NxTopology()
+        self.tolerance = tolerance
+        self.refresh_interval = refresh_interval
+        self.clean()
+
+    def flush(self):
+        self.paths.clear()
+        self.ref_weights.clear()
+        self.flushes += 1
+
+    def _update(self, key, old, new):
+        if new == old:
+            return
+
+        ref = self.ref_weights.setdefault(key, old)
+        if abs(new - ref) > self.tolerance:
+            self.flush()
+
+    def set_node_weight(self, ip, weight):
+        self._update(ip, self.topology.node_weight(ip), weight)
+        self.topology.set_node_weight(ip, weight)
+
+    def set_edge_weight(self, src_ip, dst_ip, weight):
+        old = self.topology.edge_weight(src_ip, dst_ip)
+        self._update((src_ip, dst_ip), old, weight)
+        self.topology.set_edge_weight(src_ip, dst_ip, weight)
+
+    def path(self, src_ip, dst_ip):
+        """ Return the shortest path from src_ip to dst_ip, both included """
+        now = self.event_queue.now
+        cached = self.paths.get((src_ip, dst_ip))
+
+        if cached is not None:
+            path, when = cached
+            if self.refresh_interval is None or \
+               now - when < self.refresh_interval:
+                self.hits += 1
+                return path
+
+        self.misses += 1
+        if self.profile is None:
+            path = self.topology.shortest_path(src_ip, dst_ip)
+        else:
+            start = time.perf_counter()
+            path = self.topology.shortest_path(src_ip, dst_ip)
+            self.profile.dijkstra_calls += 1
+            self.profile.dijkstra_time += time.perf_counter() - start
+        self.paths[(src_ip, dst_ip)] = (path, now)
+
+        return path
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'route_hits': self.hits,
+            'route_misses': self.misses,
+            'route_flushes': self.flushes,
+            'route_hit_rate': self.hits / lookups if lookups else 0,
+        }
@@ -0,0 +1,214 @@
+import gc
+import pickle
+import zlib
+from random import Random
+
+from .core import Event, EventQueue, PacketPool, TraceRecorder, \
+    instrument, trace_layer
+from .layers import Channel
+from .metrics import MetricsCollector
+from .profiling import Profile
+from .routing import RouteCache
+from .strategy import StrategyEngine
+from .streams import RandomStreams
+from .topology import TOPOLOGIES
+from .util import atomic_write
+
+
+class Simulation:
+    """ Context owning all the state of one simulation.
+
+    Layers receive the simulation they belong to and reach the event queue,
+    the topology, the routing table, the other layers and the random
+    generators only through it, so many simulations can live (and be
+    stepped in turns) in the same process.
+    """
+    def __init__(self, seed=None, topology='networkx', route_tolerance=0,
+                 route_refresh=None, drop_lim=10, lifo_ties=False,
+                 trace=False, reuse_packets=True, profile=False,
+                 queue_limit=None, burst=1, channel_lifo=False,
+                 trace_path=None):
+        self.event_queue = EventQueue(lifo_ties=lifo_ties)
+        self.topology = TOPOLOGIES[topology]()
+        self.route_cache = RouteCache(self.event_queue,
+                                      topology=self.topology,
+                                      tolerance=route_tolerance,
+                                      refresh_interval=route_refresh)
+
+        # packets from nodes with a higher drop score are not forwarded
+        self.drop_lim = drop_lim
+
+        # service of the channels: buffer size (None is unbounded), packets
+        # sent per transmission and the legacy LIFO order of the queues
+        self.queue_limit = queue_limit
+        self.burst = burst
+        self.channel_lifo = channel_lifo
+
+        # python generator for the scenario, numpy streams for the layers
+        self.random = Random(seed)
+        self.streams = RandomStreams(seed)
+
+        # all the layers of the simulation, in order to look them up by id
+        self.layers = {}
+        self.last_layer_id = 0
+        self.last_packet_id = 0
+        self.packets = PacketPool(self.new_packet_id, reuse=reuse_packets)
+
+        # counters of the hot paths, only if requested
+        self.profile = Profile() if profile else None
+        self.route_cache.profile = self.profile
+
+        # structured trace of the logged calls of the layers, see
+        # core.trace_layer
+        self.trace = [] if trace else None
+        instrument()
+
+        # binary trace of every packet event, written to trace_path
+        self.recorder = TraceRecorder(trace_path) if trace_path else None
+
+        # running totals of the traffic, by strategy of the nodes
+        self.metrics = MetricsCollector()
+
+        # selfish flags and drop scores of the nodes, as arrays
+        self.strategy = StrategyEngine(self.metrics)
+
+        # batch advancing this simulation with other replicas, see batch.Batch
+        self.batch = None
+
+        # scenario parameters, nodes by ip and results, set by the driver
+        self.args = {}
+        self.batmans = {}
+        self.snapshots = []
+
+    def __repr__(self):
+        return "<Simulation(now: {}, layers: {})>".format(
+            self.event_queue.now, len(self.layers))
+
+    def register(self, layer):
+        """ Store a new layer, returning its unique id """
+        self.last_layer_id += 1
+        self.layers[self.last_layer_id] = layer
+        if self.trace is not None:
+            trace_layer(layer)
+        return self.last_layer_id
+
+    def new_packet_id(self):
+        self.last_packet_id += 1
+        return self.last_packet_id
+
+    def schedule(self, action, when):
+        return self.event_queue.add(Event(action, when))
+
+    def step(self):
+        """ Trigger the next event, return None when there are none left """
+        return self.event_queue.next()
+
+    def run(self, until=None, checkpoint_path=None,
+            checkpoint_interval=None):
+        """ Run until the queue is empty or the next event is after until.
+
+        With checkpoint_path, the state is saved there every
+        checkpoint_interval of simulated time, to resume a long run with
+        Simulation.load after a crash.
+        """
+        if checkpoint_path is not None:
+            if checkpoint_interval is None or checkpoint_interval <= 0:
+                raise ValueError("checkpoint_path needs a positive "
+                                 "checkpoint_interval")
+            self._run_checkpointed(until, checkpoint_path,
+                                   checkpoint_interval)
+            return
+
+        if self.profile is not None:
+            self.profile.run(self, until)
+            return
+
+        while True:
+            when = self.event_queue.next_time()
+            if when is None or (until is not None and when > until):
+                break
+            self.event_queue.next()
+
+    def _run_checkpointed(self, until, path, interval):
+        stop = self.event_queue.now
+        while True:
+            stop += interval
+            if until is not None:
+                stop = min(stop, until)
+            self.run(until=stop)
+
+            when = self.event_queue.next_time()
+            if when is None or (until is not None and when > until):
+                break
+            self.save(path)
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        # a restored simulation runs on its own, out of any batch
+        state['batch'] = None
+        return state
+
+    def checkpoint(self, compress=True):
+        """ Complete state of the simulation, as bytes.
+
+        Pending events, queues of the channels, scores, counters of the
+        apps, random generators and snapshots are all included, so that
+        restore() continues exactly where the simulation stopped. The
+        actions of the events must be picklable (bound methods and partials
+        of module level functions are).
+        """
+        data = pickle.dumps(self, protocol=pickle.HIGHEST_PROTOCOL)
+        return zlib.compress(data, 1) if compress else data
+
+    @staticmethod
+    def restore(data, resume_trace=False):
+        """ Simulation saved by checkpoint().
+
+        The restored simulation does not write the binary trace, which
+        stays with the original, unless resume_trace: then it goes on
+        appending to the trace file from the checkpoint, which is only
+        right when the original is gone, as load() after a crash.
+        """
+        if not data.startswith(b'\x80'):
+            data = zlib.decompress(data)
+
+        # the collector would walk the whole graph of new objects many
+        # times while they are created
+        enabled = gc.isenabled()
+        gc.disable()
+        try:
+            sim = pickle.loads(data)
+        finally:
+            if enabled:
+                gc.enable()
+
+        if sim.recorder is not None:
+            if resume_trace:
+                sim.recorder.reopen()
+            else:
+                sim.recorder = None
+        return sim
+
+    def fork(self):
+        """ Independent copy of the simulation, from its current state.
+
+        The copy does not write the binary trace, which stays with self.
+        """
+        return self.restore(self.checkpoint(compress=False))
+
+    def save(self, path):
+        with atomic_write(path) as file:
+            file.write(self.checkpoint())
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as file:
+            return cls.restore(file.read(), resume_trace=True)
+
+    def channel_stats(self):
+        """ Queue statistics of all the channels, by channel id """
+        return {id_: layer.stats() for id_, layer in self.layers.items()
+                if isinstance(layer, Channel)}
+
+    def stop(self):
+        self.event_queue.clean()
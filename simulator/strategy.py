@@ -0,0 +1,123 @@
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from .util import grow
+
+
+def neighbour_majority(selfish, drop_score, selfish_neigh, n_neigh, drop_lim):
+    """ Approach 1 of update_selfishness, for all the nodes at once.
+
+    If neighbours are almost all altruistic (less than 5 selfish), become
+    selfish; if I have a bad reputation, try gaining it.
+    """
+    penalised = drop_score > drop_lim
+
+    new_selfish = selfish.copy()
+    new_selfish[penalised] = False
+    new_selfish[~penalised & (selfish_neigh < 5)] = True
+
+    return new_selfish
+
+
+def selfish_fraction(selfish, drop_score, selfish_neigh, n_neigh, drop_lim,
+                     threshold=0.5):
+    """ Become selfish while less than threshold of the neighbours are """
+    penalised = drop_score > drop_lim
+    fraction = selfish_neigh / np.maximum(n_neigh, 1)
+
+    new_selfish = selfish.copy()
+    new_selfish[penalised] = False
+    new_selfish[~penalised & (fraction < threshold)] = True
+
+    return new_selfish
+
+
+STRATEGIES = {
+    'neighbour_majority': neighbour_majority,
+    'selfish_fraction': selfish_fraction,
+}
+
+
+class StrategyEngine:
+    """ Strategy state of all the nodes, stored in NumPy arrays.
+
+    BatmanLayer keeps its selfish flag and drop score here, indexed by the
+    order of creation of the nodes. The links between nodes form a sparse
+    adjacency matrix, so the number of selfish neighbours of every node is
+    a single matrix-vector product. A strategy is a function of the arrays
+
+        strategy(selfish, drop_score, selfish_neigh, n_neigh, drop_lim)
+
+    returning the new selfish array; all nodes move at the same time.
+    """
+    def __init__(self, metrics=None):
+        # metrics are told of every change of strategy
+        self.metrics = metrics
+
+        self.ips = []
+        self.index = {
+            # ip: node index
+        }
+        self.selfish = np.zeros(0, dtype=bool)
+        self.drop_score = np.zeros(0, dtype=np.int64)
+        self._n_nodes = 0
+
+        self.links = set()
+        self._adjacency = None
+
+    def add_node(self, ip, selfish):
+        idx = self._n_nodes
+        self._n_nodes += 1
+        self.index[ip] = idx
+        self.ips.append(ip)
+
+        self.selfish = grow(self.selfish, self._n_nodes)
+        self.drop_score = grow(self.drop_score, self._n_nodes)
+        self.selfish[idx] = selfish
+        self.drop_score[idx] = 0
+        self._adjacency = None
+
+        return idx
+
+    def add_link(self, src_ip, dst_ip):
+        self.links.add((self.index[src_ip], self.index[dst_ip]))
+        self._adjacency = None
+
+    def set_selfish(self, idx, selfish):
+        self.selfish[idx] = selfish
+        if self.metrics is not None:
+            self.metrics.set_selfish(self.ips[idx], selfish)
+
+    def adjacency(self):
+        """ Sparse matrix with a 1 in (i, j) if j is a neighbour of i """
+        if self._adjacency is None:
+            n = self._n_nodes
+            if self.links:
+                src, dst = np.array(sorted(self.links)).T
+            else:
+                src = dst = np.zeros(0, dtype=int)
+            self._adjacency = csr_matrix(
+                (np.ones(len(src), dtype=np.int64), (src, dst)), shape=(n, n))
+        return self._adjacency
+
+    def step(self, strategy, drop_lim):
+        """ Apply strategy to all the nodes, return the number of flips """
+        n = self._n_nodes
+        selfish = self.selfish[:n]
+        drop_score = self.drop_score[:n]
+
+        adjacency = self.adjacency()
+        selfish_neigh = adjacency.dot(selfish.astype(np.int64))
+        n_neigh = np.diff(adjacency.indptr)
+
+        new_selfish = strategy(selfish, drop_score, selfish_neigh, n_neigh,
+                               drop_lim)
+
+        changed = np.flatnonzero(new_selfish != selfish)
+        if self.metrics is not None:
+            for idx in changed:
+                self.metrics.set_selfish(self.ips[idx],
+                                         bool(new_selfish[idx]))
+        self.selfish[:n] = new_selfish
+
+        return len(changed)
@@ -0,0 +1,106 @@
+import hashlib
+
+from numpy.random import Generator, PCG64, SeedSequence
+
+
+class Variates:
+    """ Iterator over random variates, drawn from a generator in blocks.
+
+    Calling a numpy generator for a single value costs far more than the
+    value itself: the block is drawn with one vectorized call and converted
+    to python numbers, then handed out one at a time and refilled lazily.
+    The generator itself is only created at the first draw.
+
+    Pickled variates keep the state of the generator before the current
+    block instead of the block itself, which is drawn again on restore.
+    """
+    def __init__(self, streams, key, method, args, block_size):
+        self.streams = streams
+        self.key = key
+        self.generator = None
+        self.method = method
+        self.args = args
+        self.block_size = block_size
+
+        self.block = []
+        self.pos = 0
+        # state of the generator before drawing the current block, and
+        # position in it when pickled
+        self.block_state = None
+        self.restored_pos = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.pos == len(self.block):
+            self._refill()
+
+        value = self.block[self.pos]
+        self.pos += 1
+        return value
+
+    def _refill(self):
+        if self.generator is None and self.block_state is not None:
+            # restored from a pickle: draw the same block again
+            bit_generator = PCG64()
+            bit_generator.state = self.block_state
+            self.generator = Generator(bit_generator)
+            self._draw()
+            self.pos = self.restored_pos
+            if self.pos < len(self.block):
+                return
+
+        if self.generator is None:
+            self.generator = self.streams.generator(self.key)
+        self.block_state = self.generator.bit_generator.state
+        self._draw()
+        self.pos = 0
+
+    def _draw(self):
+        draw = getattr(self.generator, self.method)
+        self.block = draw(*self.args, size=self.block_size).tolist()
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        # variates restored and not used since keep their position
+        if self.generator is not None:
+            state['restored_pos'] = self.pos
+        state['generator'] = None
+        state['block'] = []
+        state['pos'] = 0
+        return state
+
+
+class RandomStreams:
+    """ Independent, reproducible random streams of one simulation.
+
+    Every stream is identified by a key, e.g. ('channel', src_ip, dst_ip):
+    its generator is seeded from the simulation seed and the key only, so
+    a channel or an application draws the same values whatever the order
+    of creation of the others and whatever the number of their draws.
+    """
+    def __init__(self, seed, block_size=256):
+        self.seed = seed
+        self.block_size = block_size
+
+    def generator(self, key):
+        # 128 bits of the key, as four 32-bit words: a single word would
+        # give two of the thousands of streams of a run the same seed
+        digest = hashlib.blake2b(repr(key).encode(), digest_size=16).digest()
+        spawn_key = tuple(int.from_bytes(digest[i:i + 4], 'little')
+                          for i in range(0, len(digest), 4))
+        return Generator(PCG64(SeedSequence(self.seed, spawn_key=spawn_key)))
+
+    def variates(self, key, method, *args):
+        return Variates(self, key, method, args, self.block_size)
+
+    def uniform(self, key, low=0.0, high=1.0):
+        return self.variates(key, 'uniform', low, high)
+
+    def integers(self, key, low, high):
+        """ Integers in [low, high), like Generator.integers """
+        return self.variates(key, 'integers', low, high)
+
+    def geometric(self, key, p):
+        return self.variates(key, 'geometric', p)
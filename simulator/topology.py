@@ -0,0 +1,446 @@
+import networkx as nx
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+from scipy.spatial import cKDTree
+
+from .core import DEFAULT_WEIGHT
+from .util import grow
+
+
+class NxTopology:
+    """ Topology stored in a networkx graph, one dict lookup at a time """
+    def __init__(self, graph=None):
+        self.graph = graph if graph is not None else nx.DiGraph()
+
+    def clear(self):
+        self.graph.clear()
+
+    def add_node(self, ip, selfish, x, y, weight):
+        self.graph.add_node(ip, selfish=int(selfish), x=x, y=y, weight=weight)
+
+    def add_edge(self, src_ip, dst_ip, weight=DEFAULT_WEIGHT):
+        self.graph.add_edge(src_ip, dst_ip)
+        self.graph[src_ip][dst_ip]['weight'] = weight
+
+    def node_weight(self, ip):
+        return self.graph.nodes[ip]['weight']
+
+    def edge_weight(self, src_ip, dst_ip):
+        return self.graph[src_ip][dst_ip].get('weight', DEFAULT_WEIGHT)
+
+    def set_node_weight(self, ip, weight):
+        self.graph.nodes[ip]['weight'] = weight
+
+    def set_edge_weight(self, src_ip, dst_ip, weight):
+        self.graph[src_ip][dst_ip]['weight'] = weight
+
+    def weight_edge(self, u, v, d):
+        # avoid double counting of node weight in the path
+        w_u = self.graph.nodes[u]['weight'] / 2
+        w_v = self.graph.nodes[v]['weight'] / 2
+        w_d = d.get('weight', DEFAULT_WEIGHT)
+
+        return w_u + w_v + w_d
+
+    def shortest_path(self, src_ip, dst_ip):
+        return nx.dijkstra_path(self.graph, src_ip, dst_ip,
+                                weight=self.weight_edge)
+
+    def to_networkx(self):
+        return self.graph
+
+
+class ArrayTopology:
+    """ Topology stored in NumPy arrays, routed with scipy.sparse.csgraph.
+
+    Nodes are mapped to consecutive indices; edges are kept in insertion
+    order and compiled into a CSR matrix the first time a path is needed.
+    The cost of an edge folds in half of the weight of its end nodes, as
+    weight_edge does, and the shortest path tree of a source is kept until
+    a weight changes. shortest_path_trees computes many sources in a batch.
+    """
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.ips = []
+        self.index = {
+            # ip: node index
+        }
+        self.node_w = np.zeros(0)
+        self.selfish = np.zeros(0, dtype=bool)
+        self.x = np.zeros(0)
+        self.y = np.zeros(0)
+        self._n_nodes = 0
+
+        self.edge_index = {
+            # (src index, dst index): edge index
+        }
+        self.edge_src = np.zeros(0, dtype=np.int32)
+        self.edge_dst = np.zeros(0, dtype=np.int32)
+        self.edge_w = np.zeros(0)
+        self._n_edges = 0
+
+        # CSR matrix and position of each edge in its data array
+        self._matrix = None
+        self._csr_pos = None
+        self._trees = {
+            # source index: predecessors array
+        }
+
+    def add_node(self, ip, selfish, x, y, weight):
+        if ip in self.index:
+            idx = self.index[ip]
+        else:
+            idx = self._n_nodes
+            self._n_nodes += 1
+            self.index[ip] = idx
+            self.ips.append(ip)
+            self.node_w = grow(self.node_w, self._n_nodes)
+            self.selfish = grow(self.selfish, self._n_nodes)
+            self.x = grow(self.x, self._n_nodes)
+            self.y = grow(self.y, self._n_nodes)
+            self._matrix = None
+
+        self.node_w[idx] = weight
+        self.selfish[idx] = selfish
+        self.x[idx] = x
+        self.y[idx] = y
+        self._trees.clear()
+
+    def add_edge(self, src_ip, dst_ip, weight=DEFAULT_WEIGHT):
+        key = (self.index[src_ip], self.index[dst_ip])
+        if key not in self.edge_index:
+            idx = self._n_edges
+            self._n_edges += 1
+            self.edge_index[key] = idx
+            self.edge_src = grow(self.edge_src, self._n_edges)
+            self.edge_dst = grow(self.edge_dst, self._n_edges)
+            self.edge_w = grow(self.edge_w, self._n_edges)
+            self.edge_src[idx], self.edge_dst[idx] = key
+            self._matrix = None
+
+        self.edge_w[self.edge_index[key]] = weight
+        self._trees.clear()
+
+    def node_weight(self, ip):
+        return self.node_w[self.index[ip]]
+
+    def edge_weight(self, src_ip, dst_ip):
+        key = (self.index[src_ip], self.index[dst_ip])
+        return self.edge_w[self.edge_index[key]]
+
+    def set_node_weight(self, ip, weight):
+        idx = self.index[ip]
+        if self.node_w[idx] != weight:
+            self.node_w[idx] = weight
+            self._trees.clear()
+
+    def set_edge_weight(self, src_ip, dst_ip, weight):
+        idx = self.edge_index[(self.index[src_ip], self.index[dst_ip])]
+        if self.edge_w[idx] != weight:
+            self.edge_w[idx] = weight
+            self._trees.clear()
+
+    def edge_costs(self):
+        """ Cost of each edge, node weights included, in insertion order """
+        n = self._n_edges
+        src = self.edge_src[:n]
+        dst = self.edge_dst[:n]
+        return self.node_w[src] / 2 + self.node_w[dst] / 2 + self.edge_w[:n]
+
+    def matrix(self):
+        """ CSR adjacency matrix with the current edge costs """
+        n = self._n_nodes
+        m = self._n_edges
+
+        if self._matrix is None:
+            # build the structure once; data positions map edges to entries
+            order = np.lexsort((self.edge_dst[:m], self.edge_src[:m]))
+            self._csr_pos = np.empty(m, dtype=np.int64)
+            self._csr_pos[order] = np.arange(m)
+            indptr = np.zeros(n + 1, dtype=np.int64)
+            np.cumsum(np.bincount(self.edge_src[:m], minlength=n),
+                      out=indptr[1:])
+            self._matrix = csr_matrix(
+                (np.zeros(m), self.edge_dst[:m][order], indptr),
+                shape=(n, n))
+
+        self._matrix.data[self._csr_pos] = self.edge_costs()
+        return self._matrix
+
+    def shortest_path_trees(self, src_ips):
+        """ Compute (and keep) the predecessor arrays of many sources """
+        missing = [self.index[ip] for ip in src_ips
+                   if self.index[ip] not in self._trees]
+        if missing:
+            _, predecessors = dijkstra(self.matrix(), directed=True,
+                                       indices=missing,
+                                       return_predecessors=True)
+            for src, pred in zip(missing, predecessors):
+                self._trees[src] = pred
+
+        return {ip: self._trees[self.index[ip]] for ip in src_ips}
+
+    def shortest_path(self, src_ip, dst_ip):
+        src = self.index[src_ip]
+        dst = self.index[dst_ip]
+
+        if src not in self._trees:
+            self.shortest_path_trees([src_ip])
+        pred = self._trees[src]
+
+        if src != dst and pred[dst] < 0:
+            raise nx.NetworkXNoPath(
+                "No path between {} and {}.".format(src_ip, dst_ip))
+
+        path = [dst]
+        while path[-1] != src:
+            path.append(pred[path[-1]])
+
+        return [self.ips[i] for i in reversed(path)]
+
+    def to_networkx(self):
+        """ Export the topology as a networkx graph, for plots and debug """
+        graph = nx.DiGraph()
+        for idx, ip in enumerate(self.ips):
+            graph.add_node(ip,
+                           selfish=int(self.selfish[idx]),
+                           x=float(self.x[idx]),
+                           y=float(self.y[idx]),
+                           weight=float(self.node_w[idx]))
+        for (src, dst), idx in self.edge_index.items():
+            graph.add_edge(self.ips[src], self.ips[dst],
+                           weight=float(self.edge_w[idx]))
+        return graph
+
+
+class IncrementalTopology(ArrayTopology):
+    """ ArrayTopology keeping its shortest path trees across weight changes.
+
+    The edges whose weight changed are logged instead of dropping the
+    trees. When the tree of a source is needed again, it is kept if none
+    of the edges changed since it was computed is in the tree, and none of
+    them gives a shorter path: the distances along the tree are then the
+    same, and dist[u] + cost(u, v) >= dist[v] still holds for every edge.
+    Otherwise, or after more than max_changes changes, it is recomputed.
+    A node weight changes the edge towards the node, which is in every
+    tree reaching it, so it drops all the trees.
+
+    The matrix is not rebuilt either: only the costs of the changed edges
+    and of the edges of the changed nodes are written in it. The paths
+    are exact; between paths of equal cost the kept tree may differ from
+    the one a new Dijkstra would pick.
+    """
+    def __init__(self, max_changes=32):
+        self.max_changes = max_changes
+        super().__init__()
+
+    def clear(self):
+        super().clear()
+        self._dist = {
+            # source index: distances of its tree
+        }
+        self._checked = {
+            # source index: position in the change log when last checked
+        }
+        self._changes = []
+        self._costs_at = 0
+        self._dirty_nodes = []
+        self.trees_kept = 0
+        self.trees_rebuilt = 0
+
+    def add_node(self, ip, selfish, x, y, weight):
+        super().add_node(ip, selfish, x, y, weight)
+        self._dirty_nodes.append(self.index[ip])
+
+    def add_edge(self, src_ip, dst_ip, weight=DEFAULT_WEIGHT):
+        super().add_edge(src_ip, dst_ip, weight)
+        self._changes.append(
+            self.edge_index[(self.index[src_ip], self.index[dst_ip])])
+
+    def set_node_weight(self, ip, weight):
+        idx = self.index[ip]
+        if self.node_w[idx] != weight:
+            self.node_w[idx] = weight
+            self._dirty_nodes.append(idx)
+            self._trees.clear()
+
+    def set_edge_weight(self, src_ip, dst_ip, weight):
+        idx = self.edge_index[(self.index[src_ip], self.index[dst_ip])]
+        if self.edge_w[idx] != weight:
+            self.edge_w[idx] = weight
+            self._changes.append(idx)
+
+    def matrix(self):
+        """ CSR adjacency matrix, writing the changed costs only """
+        if self._matrix is None:
+            super().matrix()
+            self._index_edges()
+        else:
+            self._update_costs()
+        self._dirty_nodes.clear()
+        self._costs_at = len(self._changes)
+        return self._matrix
+
+    def _index_edges(self):
+        """ Edges of a new matrix by source and by destination """
+        n = self._n_nodes
+        m = self._n_edges
+        self._src = self.edge_src[:m].astype(np.intp)
+        self._dst = self.edge_dst[:m].astype(np.intp)
+        self._costs = self.edge_costs()
+
+        self._out_edges = np.argsort(self._src, kind='stable')
+        self._in_edges = np.argsort(self._dst, kind='stable')
+        self._out_ptr = np.zeros(n + 1, dtype=np.intp)
+        self._in_ptr = np.zeros(n + 1, dtype=np.intp)
+        np.cumsum(np.bincount(self._src, minlength=n), out=self._out_ptr[1:])
+        np.cumsum(np.bincount(self._dst, minlength=n), out=self._in_ptr[1:])
+
+    def _update_costs(self):
+        """ Costs of the edges changed since the last call """
+        edges = [np.array(self._changes[self._costs_at:], dtype=np.intp)]
+        for node in set(self._dirty_nodes):
+            edges.append(self._out_edges[
+                self._out_ptr[node]:self._out_ptr[node + 1]])
+            edges.append(self._in_edges[
+                self._in_ptr[node]:self._in_ptr[node + 1]])
+        edges = np.concatenate(edges)
+        if len(edges):
+            self._costs[edges] = self.node_w[self._src[edges]] / 2 + \
+                self.node_w[self._dst[edges]] / 2 + self.edge_w[edges]
+            self._matrix.data[self._csr_pos[edges]] = self._costs[edges]
+
+    def _still_optimal(self, src):
+        """ Whether the edge changes since its check left the tree as is """
+        start = self._checked[src]
+        if len(self._changes) - start > self.max_changes:
+            return False
+
+        self.matrix()
+        edges = np.array(self._changes[start:], dtype=np.intp)
+        src_nodes = self._src[edges]
+        dst_nodes = self._dst[edges]
+        if (self._trees[src][dst_nodes] == src_nodes).any():
+            return False
+        dist = self._dist[src]
+        return not (dist[src_nodes] + self._costs[edges] <
+                    dist[dst_nodes] * (1 - 1e-12)).any()
+
+    def _revalidate(self, src):
+        """ Drop the tree of src if a weight change may have moved it """
+        if len(self._changes) > 64 * self.max_changes:
+            # no tree is kept past max_changes: start the log again
+            self.matrix()
+            self._changes.clear()
+            self._costs_at = 0
+            self._trees.clear()
+        if src not in self._trees or \
+           self._checked[src] == len(self._changes):
+            return
+        if self._still_optimal(src):
+            self._checked[src] = len(self._changes)
+            self.trees_kept += 1
+        else:
+            del self._trees[src]
+
+    def shortest_path_trees(self, src_ips):
+        """ Compute (and keep) the predecessor arrays of many sources """
+        sources = [self.index[ip] for ip in src_ips]
+        for src in sources:
+            self._revalidate(src)
+        missing = [src for src in sources if src not in self._trees]
+        if missing:
+            matrix = self.matrix()
+            dist, predecessors = dijkstra(matrix, directed=True,
+                                          indices=missing,
+                                          return_predecessors=True)
+            for src, row, pred in zip(missing, dist, predecessors):
+                self._trees[src] = pred
+                self._dist[src] = row
+                self._checked[src] = len(self._changes)
+            self.trees_rebuilt += len(missing)
+
+        return {ip: self._trees[self.index[ip]] for ip in src_ips}
+
+    def shortest_path(self, src_ip, dst_ip):
+        self._revalidate(self.index[src_ip])
+        return super().shortest_path(src_ip, dst_ip)
+
+
+def _legacy_pairs(positions, k):
+    # same selection as the old per-row loop: argpartition with -k keeps
+    # the k *largest* distances of each row
+    diff = positions[:, np.newaxis, :] - positions[np.newaxis, :, :]
+    distance = np.sqrt(diff[..., 0]**2 + diff[..., 1]**2)
+
+    k = min(k, len(positions))
+    picked = np.argpartition(distance, -k, axis=1)[:, -k:]
+    src = np.repeat(np.arange(len(positions)), k)
+    dst = picked.ravel()
+
+    return src, dst, distance[src, dst]
+
+
+def _knn_pairs(positions, k):
+    k = min(k + 1, len(positions))
+    distance, picked = cKDTree(positions).query(positions, k=k)
+    src = np.repeat(np.arange(len(positions)), k)
+
+    return src, picked.ravel(), distance.ravel()
+
+
+def _radius_pairs(positions, radius):
+    pairs = cKDTree(positions).query_pairs(radius, output_type='ndarray')
+    src, dst = pairs[:, 0], pairs[:, 1]
+    distance = np.hypot(*(positions[src] - positions[dst]).T)
+
+    return src, dst, distance
+
+
+def find_neighbours(positions, policy='legacy', k=10, radius=None):
+    """ Return the directed links (src, dst, distance) between positions.
+
+    policy is one of:
+    - 'legacy': the selection of the original connect_batmans loop, kept to
+      reproduce the topology of older runs (it keeps the k farthest nodes)
+    - 'knn': the k nearest nodes, found with a KD-tree
+    - 'radius': all the nodes closer than radius
+
+    Each selected pair is linked in both directions; a link selected twice
+    appears once, in the position of its first appearance.
+    """
+    positions = np.asarray(positions, dtype=float)
+
+    if policy == 'legacy':
+        src, dst, distance = _legacy_pairs(positions, k)
+    elif policy == 'knn':
+        src, dst, distance = _knn_pairs(positions, k)
+    elif policy == 'radius':
+        src, dst, distance = _radius_pairs(positions, radius)
+    else:
+        raise ValueError("Unknown neighbour policy {!r}".format(policy))
+
+    # drop links to self (and to nodes in the very same position)
+    keep = distance > 0
+    src, dst, distance = src[keep], dst[keep], distance[keep]
+
+    # interleave the two directions, as connect_to is called twice
+    src, dst = np.column_stack((src, dst)), np.column_stack((dst, src))
+    src, dst = src.ravel(), dst.ravel()
+    distance = np.repeat(distance, 2)
+
+    # remove duplicates, keeping the first occurrence
+    _, first = np.unique(src * len(positions) + dst, return_index=True)
+    first.sort()
+
+    return src[first], dst[first], distance[first]
+
+
+TOPOLOGIES = {
+    'networkx': NxTopology,
+    'array': ArrayTopology,
+    'incremental': IncrementalTopology,
+}
@@ -0,0 +1,35 @@
+import os
+from contextlib import contextmanager
+
+import numpy as np
+
+
+def grow(array, size):
+    """ Return array, or a copy of it zero-padded to hold at least size items.
+
+    The capacity at least doubles, so appending one item at a time costs
+    amortized constant time.
+    """
+    if size <= len(array):
+        return array
+    grown = np.zeros(max(size, 2 * len(array)), dtype=array.dtype)
+    grown[:len(array)] = array
+    return grown
+
+
+@contextmanager
+def atomic_write(path, mode='wb'):
+    """ Open a file aside of path, renamed over it once the block completes.
+
+    Readers never see a partial file; if the block raises, the temporary
+    file is removed and path is left untouched.
+    """
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    try:
+        with open(tmp_path, mode) as file:
+            yield file
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, path)
@@ -1,17 +1,19 @@
-# import argparse
+import argparse
 import logging
-import multiprocessing as mp
+import os
 # import subprocess
 # import sys
-import time
-import datetime
 
 # import h5py
 import numpy as np
-import pandas as pd
 # from simulator import
-from test_batman import simulator_batman
-logging.basicConfig(level=logging.INFO)
+from result_cache import CachedFunction, code_version
+from sampling import EndMetrics, SeedSampler
+from sweep import Sweep, to_block
+from writer import ResultWriter
+from simulator.strategy import STRATEGIES
+from test_batman import STRATEGY, geometry_cache, simulator_batman, \
+    simulator_batman_batch
 
 # setup simulation parameters
 
@@ -39,10 +41,9 @@ drop_scores = [5, 10, 15]
 # a = np.linspace(0, 0.5, num=10)
 tot_sim = len(scenarios) * len(seeds) * len(selfish_rates) * len(app_rates)
 tot_sim *= len(updates)*len(drop_scores)
-print("Total number of combinations: {}".format(tot_sim))
 
 
-def combinations():
+def combinations(strategy=STRATEGY):
     for scenario in scenarios:
         for selfish_rate in selfish_rates:
             for app_rate in app_rates:
@@ -55,99 +56,156 @@ def combinations():
                                 'app_rate': app_rate,
                                 's': seed,
                                 'update_time': update_time,
-                                'drop_lim': score_lim
+                                'drop_lim': score_lim,
+                                'strategy': strategy
                                 }
 
 
-# init parameter generator
-combos = combinations()
-# setup pool of workers
-available_threads = mp.cpu_count()  # 32  # se in coda dentro 'Blade'
-p = mp.Pool(available_threads)
-# prepare backup
-time_str = datetime.datetime.utcnow().strftime('%Y-%m-%d-%H-%M-%S')
-# clean old results
-# mv_str = "mv results/simulation_results.hdf5 \
-#             results/simulation_results.hdf5.bak_{}".format(time_str)
-# subprocess.call(mv_str, shell=True)
-store = pd.HDFStore("/home/pittaroa/project_blockchain_GT/results/simulation_results_0_{}.hdf5".format(time_str))
-results = []
-failures = 0
-count_ended = 0
-num_stores = 1
-
-
-def start_new_thread():
-    global available_threads, combos, results, p
+def points(strategy=STRATEGY):
+    """ Parameters of every point of the grid, without the seed """
+    for scenario in scenarios:
+        for selfish_rate in selfish_rates:
+            for app_rate in app_rates:
+                for update_time in updates:
+                    for score_lim in drop_scores:
+                        yield {
+                            **scenario,
+                            'selfish_rate': selfish_rate,
+                            'app_rate': app_rate,
+                            'update_time': update_time,
+                            'drop_lim': score_lim,
+                            'strategy': strategy
+                            }
+
+
+def batch_combinations(strategy=STRATEGY):
+    """ Same runs as combinations, all the seeds of a point in one task """
+    for point in points(strategy):
+        yield dict(point, seeds=seeds)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run the simulation sweep")
+    parser.add_argument('-o', '--output-dir', default='results',
+                        help="directory of results, manifest and status")
+    parser.add_argument('--parquet', action='store_true',
+                        help="write partitioned Parquet instead of HDF5")
+    parser.add_argument('--chunk-time', type=float, default=5,
+                        help="seconds of simulation per task, 0 to send "
+                        "one simulation per task")
+    parser.add_argument('--cache-dir', default=None,
+                        help="cache of results, default OUTPUT_DIR/cache")
+    parser.add_argument('--cache-size', type=float, default=10,
+                        help="maximum size of the cache in GiB, 0 to "
+                        "disable it")
+    parser.add_argument('--geometry-dir', default=None,
+                        help="cache of the positions and links of the "
+                        "scenarios, default OUTPUT_DIR/geometry")
+    parser.add_argument('--batch', action='store_true',
+                        help="run all the seeds of a point together, as a "
+                        "single task")
+    parser.add_argument('--strategy', default=STRATEGY,
+                        choices=['legacy'] + sorted(STRATEGIES),
+                        help="strategy update of the nodes, 'legacy' moves "
+                        "them one at a time")
+    parser.add_argument('--adaptive', action='store_true',
+                        help="run seeds in rounds, until the confidence "
+                        "interval of the end metrics is tight enough")
+    parser.add_argument('--ci-metrics', nargs='+',
+                        default=['selfish_num', 'altruistic_rx/altruistic_tx'],
+                        help="end metrics of --adaptive, a/b is a ratio")
+    parser.add_argument('--ci-width', type=float, default=0.05,
+                        help="target half width of the confidence interval, "
+                        "relative to the mean")
+    parser.add_argument('--min-seeds', type=int, default=10,
+                        help="seeds of the first round of each point")
+    parser.add_argument('--round-seeds', type=int, default=10,
+                        help="seeds of the following rounds")
+
+    options = parser.parse_args()
+    if options.batch and options.adaptive:
+        parser.error("--batch and --adaptive cannot be combined")
+    if options.batch and options.strategy == 'legacy':
+        parser.error("--batch moves all the nodes at once, it needs a "
+                     "--strategy other than 'legacy'")
+    return options
+
+
+def main():
+    options = parse_args()
+    logging.basicConfig(level=logging.INFO)
+    print("Total number of combinations: {}".format(tot_sim))
+
+    # results are stored by a separate process, fed by the pool callbacks;
+    # it lists the runs in the manifest once their results are written
+    manifest_path = os.path.join(options.output_dir, 'manifest.jsonl')
+    writer = ResultWriter(options.output_dir, parquet=options.parquet,
+                          manifest_path=manifest_path)
+    writer.start()
+
+    # positions and links are built once per geometry, for all the workers
+    geometry_cache.configure(
+        options.geometry_dir or os.path.join(options.output_dir, 'geometry'),
+        version=code_version())
+
+    # with --batch each task is a batch of the replicas of a point
+    function = simulator_batman
+    combos = combinations(options.strategy)
+    total = tot_sim
+    if options.batch:
+        function = simulator_batman_batch
+        combos = batch_combinations(options.strategy)
+        total = tot_sim // len(seeds)
+
+    # results of runs already computed by any sweep are read from the cache
+    if options.cache_size > 0:
+        cache_dir = options.cache_dir or \
+            os.path.join(options.output_dir, 'cache')
+        function = CachedFunction(function, cache_dir,
+                                  max_bytes=int(options.cache_size * 2**30))
+
+    # with --adaptive the seeds of each point are decided by the sampler,
+    # from the end metrics of its previous runs
+    on_result = writer.put
+    sampler = None
+    if options.adaptive:
+        sampler = SeedSampler(points(options.strategy), seeds, options.ci_metrics,
+                              os.path.join(options.output_dir,
+                                           'sampling.jsonl'),
+                              min_seeds=options.min_seeds,
+                              round_seeds=options.round_seeds,
+                              rel_width=options.ci_width,
+                              manifest_path=manifest_path)
+        function = EndMetrics(function, options.ci_metrics)
+        combos = sampler
+
+        def on_result(args, result):
+            sampler.on_result(args, result)
+            writer.put(args, result)
+
+    # completed runs are listed in the manifest: a restarted sweep skips them
+    sweep = Sweep(function,
+                  combos,
+                  manifest_path=manifest_path,
+                  on_result=on_result,
+                  status_path=os.path.join(options.output_dir,
+                                           'progress.txt'),
+                  total=total,
+                  chunk_time=options.chunk_time or None,
+                  on_error=sampler.on_done if sampler else None,
+                  on_skip=sampler.on_done if sampler else None,
+                  record=False)
     try:
-        tmp_var = next(combos)
-        # start the thread and program a new start when the function ends
-        res = p.apply_async(
-                            simulator_batman,
-                            (tmp_var,),
-                            callback=process_finished,
-                            error_callback=process_error
-                            )
-        results.append(res)
-        available_threads -= 1
-    except StopIteration:
-        available_threads -= 1
-        return
-
-
-def process_finished(res):
-    global available_threads, count_ended, store, num_stores, time_str
-    store.append(
-                'results',
-                pd.DataFrame.from_records(res),
-                format='t',
-                data_columns=True
-                )
-    available_threads += 1
-    count_ended += 1
-    # save into smaller files to avoid huge RAM consumption and storing data if
-    # failure happens meanwhile
-    if count_ended % 10000 == 0:
-        store.close()
-        store = pd.HDFStore("/home/pittaroa/project_blockchain_GT/results/simulation_results_{}_{}.hdf5".format(num_stores, time_str))
-        num_stores += 1
-    start_new_thread()
-
-
-def process_error(err):
-    global failures, count_ended
-    print("An error occoured: ")
-    print("class: ", err.__class__)
-    print("message: ", err)
-    print("Traceback:", err.__traceback__)
-    failures += 1
-    count_ended += 1
-    start_new_thread()
-
-
-# check that I have the same number of simulations
-while(available_threads > 0):
-    start_new_thread()
-    # avoid program from finishing until all processes are done
-time.sleep(1)  # wait 1 second before re-checking
-
-with open("/home/pittaroa/Public-Htdocs/progress.txt", "w") as file:
-    file.write("Started {} sim at time {}".format(tot_sim, time_str))
-
-while(len(results) > 0):
-    time.sleep(10)  # wait 10 seconds before re-checking
-    finish = [x.ready() for x in results]
-    # remove finished results
-    # update results list, minding that the list can increase in size
-    new_res = [r for i, r in enumerate(results[:len(finish)]) if not finish[i]]
-    results = new_res + results[len(finish):]
-    # print("checking how many processes are running: ", len(results))
-    if count_ended % 100 == 0:
-        with open("/home/pittaroa/Public-Htdocs/progress.txt", "w") as file:
-            file.write("Done {} sim out of {} \n".format(count_ended, tot_sim))
-            file.write("Progress done: {:.3%}".format(count_ended/tot_sim))
-store.close()
-with open("/home/pittaroa/Public-Htdocs/progress.txt", "w") as file:
-    time_str = datetime.datetime.utcnow().strftime('%Y-%m-%d-%H-%M-%S')
-    file.write("Simulation ended with {} \
-                failures at {}".format(failures, time_str))
+        completed, failures = sweep.run()
+        if sampler is not None:
+            # seeds used and confidence intervals of every point
+            writer.put([], to_block([{'sampling': sampler.summary()}]))
+            sampler.close()
+    finally:
+        writer.close()
+    print("Simulation ended with {} completed, {} failures".format(
+        completed, failures))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,362 @@
+""" Resumable parameter sweep over a pool of worker processes """
+import datetime
+import json
+import multiprocessing as mp
+import os
+import threading
+import time
+
+import numpy as np
+
+from simulator.util import atomic_write
+
+
+# yielded by combos to have the runs collected so far submitted at once,
+# e.g. before waiting for their results to decide the next runs
+FLUSH = object()
+
+
+class SweepAborted(Exception):
+    """ Raised by on_result when the sweep cannot go on, e.g. when the
+    results can no longer be stored """
+
+
+def normalize_args(args):
+    """ Parameters as plain python values, with a stable order """
+    return {key: (value.item() if hasattr(value, 'item') else value)
+            for key, value in sorted(args.items())}
+
+
+def args_key(args):
+    return json.dumps(normalize_args(args), sort_keys=True)
+
+
+def to_tables(result):
+    """ Rows of a run by table: a plain list of rows goes to 'results' """
+    return result if isinstance(result, dict) else {'results': result}
+
+
+def to_columns(records):
+    """ Turn a list of dicts into a dict of arrays.
+
+    Keys missing from some of the dicts (e.g. a profile counter of an
+    event that never happened in a run) are filled with 0.
+    """
+    keys = {}
+    for record in records:
+        keys.update(dict.fromkeys(record))
+    return {key: np.array([record.get(key, 0) for record in records])
+            for key in keys}
+
+
+def to_block(results):
+    """ Columnar block {table: {column: array}} of the results of runs """
+    rows = {}
+    for result in results:
+        for table, table_rows in to_tables(result).items():
+            rows.setdefault(table, []).extend(table_rows)
+    return {table: to_columns(table_rows)
+            for table, table_rows in rows.items()}
+
+
+def run_chunk(function, chunk):
+    """ Run function on every args of chunk, in the worker process.
+
+    Returns the results of all the successful runs as a single columnar
+    block, the args of those runs, the failed (args, error) pairs and the
+    mean duration of a run, which drives the size of the next chunks.
+    """
+    results = []
+    done = []
+    failed = []
+
+    start = time.perf_counter()
+    for args in chunk:
+        try:
+            results.append(function(args))
+            done.append(args)
+        except Exception as err:
+            failed.append((args, err))
+    duration = (time.perf_counter() - start) / len(chunk)
+
+    return to_block(results), done, failed, duration
+
+
+class Manifest:
+    """ Append-only file with the parameters of every completed run.
+
+    Each line is the JSON of the normalized args. Lines are flushed and
+    synced as soon as runs are recorded: if runs are only recorded after
+    their results are stored, after a crash the file lists exactly the
+    runs whose results were already stored.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+
+        if os.path.exists(path):
+            with open(path) as file:
+                for line in file:
+                    line = line.strip()
+                    # the last line may be truncated by a crash
+                    try:
+                        self.done.add(args_key(json.loads(line)))
+                    except ValueError:
+                        continue
+
+        self.file = open(path, 'a')
+
+    def __contains__(self, args):
+        return args_key(args) in self.done
+
+    def add(self, args):
+        self.extend([args])
+
+    def extend(self, args_list):
+        for args in args_list:
+            key = args_key(args)
+            self.done.add(key)
+            self.file.write(key + '\n')
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+
+class Sweep:
+    """ Run function over combos, skipping the runs already in manifest.
+
+    At most max_in_flight runs are submitted to the pool at any time: the
+    main thread blocks on a semaphore released by the pool callbacks, so
+    there is no polling. on_result(args, result) is called in the result
+    thread of the pool, before the run is recorded as completed. With
+    record=False the manifest is only read, to skip the runs already
+    done: on_result must then record the runs once their results are
+    stored (see writer.ResultWriter). If on_result raises SweepAborted,
+    no more runs are submitted and run() raises it.
+    Throughput and ETA are written to status_path, at most every
+    status_interval seconds.
+
+    combos may be a generator deciding the next runs from the results of
+    the previous ones (see sampling.SeedSampler): on_error(args) and
+    on_skip(args) tell it of the runs failed and skipped, and FLUSH
+    submits the partial chunk.
+
+    With chunk_time set, each task runs a chunk of args in a worker, which
+    sends back a single columnar block ({table: {column: array}}, see
+    to_block) for all of them: on_result(list of args, block) is then
+    called once per chunk. The size of the chunks follows the mean run
+    duration observed so far, so that a chunk takes about chunk_time
+    seconds.
+    """
+    def __init__(self, function, combos, manifest_path, on_result,
+                 status_path=None, processes=None, max_in_flight=None,
+                 total=None, status_interval=10, chunk_time=None,
+                 max_chunk_size=1000, on_error=None, on_skip=None,
+                 record=True):
+        self.function = function
+        self.combos = combos
+        self.manifest = Manifest(manifest_path)
+        self.record = record
+        self.on_result = on_result
+        self.on_error = on_error
+        self.on_skip = on_skip
+        self.status_path = status_path
+        self.processes = processes or mp.cpu_count()
+        self.max_in_flight = max_in_flight or 2 * self.processes
+        self.total = total
+        self.status_interval = status_interval
+        self.chunk_time = chunk_time
+        self.max_chunk_size = max_chunk_size
+        # exponential average of the duration of a run, once observed
+        self.run_duration = None
+
+        self.skipped = 0
+        self.completed = 0
+        self.failures = 0
+        # the SweepAborted raised by on_result, if any
+        self.aborted = None
+        self.in_flight = threading.Semaphore(self.max_in_flight)
+        self.lock = threading.Lock()
+        self.start_time = None
+        self.last_status = 0
+
+    def run(self):
+        self.start_time = time.time()
+        pool = mp.Pool(self.processes)
+
+        try:
+            if self.chunk_time is None:
+                self._submit_runs(pool)
+            else:
+                self._submit_chunks(pool)
+
+            if self.aborted is None:
+                pool.close()
+                pool.join()
+        finally:
+            pool.terminate()
+            self.manifest.close()
+            self.write_status(final=True)
+
+        if self.aborted is not None:
+            raise self.aborted
+        return self.completed, self.failures
+
+    def _pending(self):
+        for args in self.combos:
+            if self.aborted is not None:
+                return
+            if args is FLUSH:
+                yield args
+                continue
+            if args in self.manifest:
+                self.skipped += 1
+                if self.on_skip is not None:
+                    self.on_skip(args)
+                continue
+            yield args
+
+    def _submit_runs(self, pool):
+        for args in self._pending():
+            if args is FLUSH:
+                continue
+            self.in_flight.acquire()
+            pool.apply_async(self.function,
+                             (args,),
+                             callback=self._finished_callback(args),
+                             error_callback=self._error_callback(args))
+
+    def chunk_size(self):
+        if self.run_duration is None:
+            return 1
+        size = int(self.chunk_time / max(self.run_duration, 1e-6))
+        return max(1, min(size, self.max_chunk_size))
+
+    def _submit_chunks(self, pool):
+        chunk = []
+        for args in self._pending():
+            if args is FLUSH:
+                if chunk:
+                    self._submit_chunk(pool, chunk)
+                    chunk = []
+                continue
+            chunk.append(args)
+            if len(chunk) >= self.chunk_size():
+                self._submit_chunk(pool, chunk)
+                chunk = []
+        if chunk:
+            self._submit_chunk(pool, chunk)
+
+    def _submit_chunk(self, pool, chunk):
+        self.in_flight.acquire()
+        pool.apply_async(run_chunk,
+                         (self.function, chunk),
+                         callback=self._chunk_callback(),
+                         error_callback=self._error_callback(chunk))
+
+    def _chunk_callback(self):
+        def callback(result):
+            block, done, failed, duration = result
+            try:
+                with self.lock:
+                    if self.run_duration is None:
+                        self.run_duration = duration
+                    else:
+                        self.run_duration = \
+                            0.8 * self.run_duration + 0.2 * duration
+
+                for args, err in failed:
+                    self._report_error(args, err)
+                if done and self.aborted is None:
+                    self.on_result(done, block)
+                    with self.lock:
+                        if self.record:
+                            self.manifest.extend(done)
+                        self.completed += len(done)
+            except SweepAborted as err:
+                self._abort(done, err)
+            except Exception as err:
+                self._report_error(done, err)
+            finally:
+                self.in_flight.release()
+                self.write_status()
+        return callback
+
+    def _finished_callback(self, args):
+        def callback(result):
+            try:
+                if self.aborted is None:
+                    self.on_result(args, result)
+                    with self.lock:
+                        if self.record:
+                            self.manifest.add(args)
+                        self.completed += 1
+            except SweepAborted as err:
+                self._abort(args, err)
+            except Exception as err:
+                self._report_error(args, err)
+            finally:
+                self.in_flight.release()
+                self.write_status()
+        return callback
+
+    def _error_callback(self, args):
+        def callback(err):
+            self._report_error(args, err)
+            self.in_flight.release()
+            self.write_status()
+        return callback
+
+    def _abort(self, args, err):
+        with self.lock:
+            if self.aborted is None:
+                self.aborted = err
+        self._report_error(args, err)
+
+    def _report_error(self, args, err):
+        # args is a list when a whole chunk failed
+        runs = args if isinstance(args, list) else [args]
+        with self.lock:
+            self.failures += len(runs)
+        if self.on_error is not None:
+            for run in runs:
+                self.on_error(run)
+        print("An error occoured: ")
+        print("args: ", [normalize_args(run) for run in runs])
+        print("class: ", err.__class__)
+        print("message: ", err)
+
+    def throughput(self):
+        """ Completed simulations per second since the start """
+        elapsed = time.time() - self.start_time
+        return self.completed / elapsed if elapsed > 0 else 0
+
+    def write_status(self, final=False):
+        now = time.time()
+        if self.status_path is None or \
+           (not final and now - self.last_status < self.status_interval):
+            return
+        self.last_status = now
+
+        rate = self.throughput()
+        done = self.completed + self.skipped
+        lines = [
+            "Updated at {}".format(
+                datetime.datetime.utcnow().strftime('%Y-%m-%d-%H-%M-%S')),
+            "Done {} sim ({} skipped, already in manifest), {} failures"
+            .format(done, self.skipped, self.failures),
+            "Throughput: {:.3f} sim/s".format(rate),
+        ]
+        if self.total:
+            lines.append("Progress done: {:.3%}".format(done / self.total))
+            if rate > 0:
+                eta = datetime.timedelta(
+                    seconds=int((self.total - done - self.failures) / rate))
+                lines.append("ETA: {}".format(eta))
+        if final:
+            lines.append("Sweep ended")
+
+        with atomic_write(self.status_path, 'w') as file:
+            file.write("\n".join(lines) + "\n")
@@ -1,57 +1,108 @@
-from math import exp, sqrt
-from random import randint, random, seed
+from functools import partial
+from random import Random
 import numpy as np
 # import pandas as pd
-from simulator.core import G, event_queue, Event
-from simulator.layers import BatmanLayer, ApplicationLayer, Layer
+from simulator.batch import Batch
+from simulator.core import Event
+from simulator.geometry import GeometryCache
+from simulator.layers import BatmanLayer, ApplicationLayer
+from simulator.meanfield import MeanField
+from simulator.simulation import Simulation
+from simulator.strategy import STRATEGIES
+from simulator.topology import find_neighbours
 
 # default values
 LIGHT_SPEED = 299792458
 PROC_TIME = 0.001
 SNAPSHOT_TIME = 0.5
 THRES_VAR = 10
-batmans = {}
-args_copy = {}
-snapshots = []
-
-
-def interarrival_gen():
-    while True:
-        yield random() * 10
+# bounds of the interarrival time and size of the packets of the apps
+INTERARRIVAL = (0, 10)
+SIZE = (100, 201)
+# strategy update of the nodes: 'legacy' moves them one at a time, the
+# names in STRATEGIES move them all at once
+STRATEGY = "legacy"
+
+# geometries of the scenarios, shared by the runs of this process; the
+# sweep can add a directory shared by all its workers with configure()
+geometry_cache = GeometryCache()
+
+
+def interarrival_gen(sim, ip, port):
+    return sim.streams.uniform(('interarrival', ip, port), *INTERARRIVAL)
+
+
+def size_gen(sim, ip, port):
+    return sim.streams.integers(('size', ip, port), *SIZE)
+
+
+def build_geometry(s, node_num, dim, dist_lim, policy='legacy',
+                   n_closest=10):
+    """ Positions of the nodes and their links, with p_succ and rtt.
+
+    The positions are the ones setup_simulation draws from the python
+    generator of the simulation: three draws per node, the first deciding
+    whether it is selfish, the other two its coordinates.
+    """
+    random = Random(s)
+    draws = np.array([random.random() for _ in range(3 * node_num)])
+    draws = draws.reshape(node_num, 3)
+    positions = dim * draws[:, 1:]
+
+    src, dst, distance = find_neighbours(positions,
+                                         policy=policy,
+                                         k=n_closest,
+                                         radius=dist_lim)
+
+    return {
+        'positions': positions,
+        'src': src,
+        'dst': dst,
+        'p_succ': np.exp(-distance / dist_lim),
+        'rtt': PROC_TIME + distance / LIGHT_SPEED,
+    }
 
 
-def size_gen():
-    while True:
-        yield randint(100, 200)
+def geometry(args):
+    """ Geometry of the scenario of args, from the cache if already built """
+    policy = args.get("neighbours", "legacy")
+    key = (args["s"], args["node_num"], args["dim"], args["dist_lim"],
+           policy)
+    return geometry_cache.get(
+        key, partial(build_geometry, args["s"], args["node_num"],
+                     args["dim"], args["dist_lim"], policy))
 
 
-def connect_batmans(batmans, dist_lim):
-    distance = np.zeros((len(batmans), len(batmans)))
-    for ip1 in batmans:
-        for ip2 in batmans:
-            distance[ip1][ip2] = sqrt(
-                (batmans[ip1].position[0] - batmans[ip2].position[0])**2
-                + (batmans[ip1].position[1] - batmans[ip2].position[1])**2
-            )
+def connect_batmans(batmans, dist_lim, policy='legacy', n_closest=10,
+                    links=None):
+    """ Connect the nodes with channels, following links if given.
 
-    for ip1 in batmans:
-        # pick the N-closest nodes
-        N_CLOSEST = 10
-        max_idx = np.argpartition(distance[ip1, :], -N_CLOSEST)[-N_CLOSEST:]
+    links is a geometry (see build_geometry) with the arrays src, dst,
+    p_succ and rtt; without it the links are computed from the positions.
+    """
+    ips = list(batmans)
+    if links is None:
+        positions = np.array([batmans[ip].position for ip in ips])
 
-        # ensure that they are close enough
-        neigh_nodes = max_idx[(distance[ip1, max_idx] > 0)]
+        src, dst, distance = find_neighbours(positions,
+                                             policy=policy,
+                                             k=n_closest,
+                                             radius=dist_lim)
 
-        for ip2 in neigh_nodes:
-            p_succ = exp(-distance[ip1, ip2]/dist_lim)
-            rtt = PROC_TIME + distance[ip1, ip2]/LIGHT_SPEED
+        p_succ = np.exp(-distance / dist_lim)
+        rtt = PROC_TIME + distance / LIGHT_SPEED
+    else:
+        src, dst = links['src'], links['dst']
+        p_succ, rtt = links['p_succ'], links['rtt']
 
-            batmans[ip1].connect_to(batmans[ip2], p_succ=p_succ, rtt=rtt)
-            batmans[ip2].connect_to(batmans[ip1], p_succ=p_succ, rtt=rtt)
+    for i in range(len(src)):
+        batmans[ips[src[i]]].connect_to(batmans[ips[dst[i]]],
+                                        p_succ=float(p_succ[i]),
+                                        rtt=float(rtt[i]))
     return batmans
 
 
-def connect_apps(batmans, app_rate, stop_time):
+def connect_apps(sim, batmans, app_rate, stop_time):
     # create the application for each end-to-end stream: for the simulation
     # to be reasonable, each node has to have at least one application
     apps = []
@@ -62,13 +113,14 @@ def connect_apps(batmans, app_rate, stop_time):
         for ip2 in batmans:
             if ip1 == ip2:
                 continue
-            elif random() < app_rate:
+            elif sim.random.random() < app_rate:
                 port1 = port_no
                 port2 = port_no + 1
                 port_no += 10
 
-                app1 = ApplicationLayer(interarrival_gen(),
-                                        size_gen(),
+                app1 = ApplicationLayer(sim,
+                                        interarrival_gen(sim, ip1, port1),
+                                        size_gen(sim, ip1, port1),
                                         start_time=0,
                                         stop_time=stop_time,
                                         local_port=port1,
@@ -77,8 +129,9 @@ def connect_apps(batmans, app_rate, stop_time):
                                         dst_ip=ip2)
                 batmans[ip1].connect_app(app1)
 
-                app2 = ApplicationLayer(interarrival_gen(),
-                                        size_gen(),
+                app2 = ApplicationLayer(sim,
+                                        interarrival_gen(sim, ip2, port2),
+                                        size_gen(sim, ip2, port2),
                                         start_time=0,
                                         stop_time=stop_time,
                                         local_port=port2,
@@ -91,66 +144,54 @@ def connect_apps(batmans, app_rate, stop_time):
     return apps
 
 
-def calc_app(batman):
-    tx_bytes = 0
-    rx_bytes = 0
-    num_app = 0
-    # for each app connected to this batman sum the number of tx/rx bytes
-    for app_id in batman.app_table.values():
-        this_app = Layer.all_layers[app_id]
-        tx_bytes += this_app.tx_packet_size
-        rx_bytes += this_app.rx_packet_size
-        num_app += 1
-    return (tx_bytes, rx_bytes, num_app)
-
-
-def new_snapshot():
-    global snapshots, event_queue, batmans, args_copy
-    selfish_count = 0
-    altruistic_count = 0
-    tot_tx_self = 0
-    tot_rx_self = 0
-    tot_tx_altr = 0
-    tot_rx_altr = 0
-    for ip in batmans:
-        tx_bytes, rx_bytes, num_app = calc_app(batmans[ip])
-        if batmans[ip].selfish is True:
-            selfish_count += num_app
-            tot_tx_self += tx_bytes
-            tot_rx_self += rx_bytes
-        else:
-            altruistic_count += num_app
-            tot_tx_altr += tx_bytes
-            tot_rx_altr += rx_bytes
+def new_snapshot(sim):
+    if sim.batch is not None:
+        # taken for all the replicas at once
+        sim.batch.pause(sim, 'snapshot')
+        return
+
+    event_queue = sim.event_queue
 
+    # running totals, kept up to date by apps and nodes
+    totals = sim.metrics.snapshot()
     this_snap = {
                 'time': event_queue.now,
-                **args_copy,
-                'altruistic_tx': tot_tx_altr,
-                'altruistic_rx': tot_rx_altr,
-                'selfish_tx': tot_tx_self,
-                'selfish_rx': tot_rx_self,
-                'selfish_num': selfish_count,
-                'altruistic_num': altruistic_count
+                **sim.args,
+                **totals
                 }
-    prev_snapshots = snapshots[-10:]  # last 5 seconds
-    diff = 0
-    for snap in prev_snapshots:
-        diff += abs(selfish_count - snap["selfish_num"])
-    diff = diff / 10  # average the error
-    snapshots.append(this_snap)
-    if diff > THRES_VAR:  # changed a lot: continue simulation
+    # average change over the last 5 seconds
+    diff = sim.metrics.variation(totals['selfish_num'])
+    sim.snapshots.append(this_snap)
+    if diff > sim.args.get("thres_var", THRES_VAR):  # changed a lot: continue
         next = event_queue.now + SNAPSHOT_TIME
-        event_queue.add(Event(new_snapshot, when=next))
+        event_queue.add(Event(partial(new_snapshot, sim), when=next))
     else:
         event_queue.clean()  # stop simulation if parameters are stable
 
 
-def update_selfishness():
-    global batmans, args_copy
+def update_selfishness(sim):
+    if sim.batch is not None:
+        sim.batch.pause(sim, 'update')
+        return
+
+    strategy = sim.args.get("strategy", STRATEGY)
+    if strategy == "legacy":
+        update_selfishness_sequential(sim)
+    else:
+        # all the nodes move at once, on the strategy arrays
+        sim.strategy.step(STRATEGIES[strategy], sim.drop_lim)
+
+    next = sim.event_queue.now + sim.args["update_time"]
+    sim.event_queue.add(Event(partial(update_selfishness, sim), when=next))
+
+
+def update_selfishness_sequential(sim):
+    batmans = sim.batmans
     # approach 1: if neighbours are almost all altruistic, then become selfish
     # if I have a bad reputation, try gaining it
-    drop_lim = BatmanLayer.drop_lim
+    # NOTE nodes are updated one at a time, each one seeing the new strategy
+    # of the nodes before it
+    drop_lim = sim.drop_lim
     for bat in batmans.values():
         if bat.drop_score > drop_lim:
             bat.selfish = False
@@ -159,61 +200,184 @@ def update_selfishness():
             self_neigh = [batmans[neigh].selfish for neigh in neighbours]
             if self_neigh.count(True) < 5:
                 bat.selfish = True
-    next = event_queue.now + args_copy["update_time"]
-    event_queue.add(Event(update_selfishness, when=next))
 
 
-def simulator_batman(args):
-    global args_copy, batmans, snapshots
-    args_copy = args
+def setup_simulation(args):
+    """ Build the scenario described by args, ready to be run """
     s = args["s"]
     node_num = args["node_num"]
-    dim = args["dim"]
     dist_lim = args["dist_lim"]
     app_rate = args["app_rate"]
     selfish_rate = args["selfish_rate"]
     stop_time = args["stop_time"]
-    BatmanLayer.drop_lim = args["drop_lim"]
 
-    # 1) load queue for events created in simulator module
-    seed(s)
+    # exact routing unless a tolerance or an OGM-like interval is requested
+    sim = Simulation(seed=s,
+                     topology=args.get("topology", "networkx"),
+                     route_tolerance=args.get("route_tolerance", 0),
+                     route_refresh=args.get("route_refresh"),
+                     drop_lim=args["drop_lim"],
+                     lifo_ties=args.get("lifo_ties", False),
+                     trace=args.get("trace", False),
+                     profile=args.get("profile", False),
+                     queue_limit=args.get("queue_limit"),
+                     burst=args.get("burst", 1),
+                     channel_lifo=args.get("channel_lifo", False),
+                     trace_path=args.get("trace_path"))
+    # the strategy is written in the snapshots even when defaulted
+    sim.args = dict(args, strategy=args.get("strategy", STRATEGY))
 
-    # clear global variables from previous simulation
-    Layer.all_layers.clear()
-    event_queue.clean()
-    G.clear()
-    batmans = {}
-    snapshots = []
     # add the snapshot event
-    event_queue.add(Event(new_snapshot, when=SNAPSHOT_TIME))
-    event_queue.add(Event(update_selfishness, when=args["update_time"]))
+    sim.event_queue.add(Event(partial(new_snapshot, sim), when=SNAPSHOT_TIME))
+    sim.event_queue.add(Event(partial(update_selfishness, sim),
+                              when=args["update_time"]))
     # create a number of batman layers, corresponding to nodes
 
     # set deterministic number of selfish nodes: improves reliability of
     # results in small scenarios
 
-    batmans = {
-        ip: BatmanLayer(ip,
-                        selfish=(random() < selfish_rate),
-                        position=(dim * random(), dim * random()),
-                        )
-        for ip in range(node_num)
-    }
+    # positions and links only depend on the seed and the topological
+    # parameters: they are shared by all the runs of the same geometry
+    cached = geometry(args)
+    positions = cached['positions'].tolist()
+
+    batmans = {}
+    for ip in range(node_num):
+        selfish = sim.random.random() < selfish_rate
+        # the coordinates come from the geometry, but are still drawn to
+        # keep the sequence of draws of the apps
+        sim.random.random()
+        sim.random.random()
+        batmans[ip] = BatmanLayer(sim,
+                                  ip,
+                                  selfish=selfish,
+                                  position=tuple(positions[ip]),
+                                  )
 
     # connect each other using some channels, described using a success
     # probability and round trip time
-    batmans = connect_batmans(batmans, dist_lim)
+    sim.batmans = connect_batmans(batmans, dist_lim, links=cached)
 
-    # apps = connect_apps(batmans, app_rate=app_rate, stop_time=stop_time)
-
-    # apps var never used. In fact I always use Layers.all_layers id_ param
+    # apps var never used. In fact I always use sim.layers id_ param
     # to identify the app
-    connect_apps(batmans, app_rate=app_rate, stop_time=stop_time)
+    connect_apps(sim, sim.batmans, app_rate=app_rate, stop_time=stop_time)
+
+    return sim
+
+
+def simulator_batman(args):
+    sim = setup_simulation(args)
 
     # run the simulation, until we run out of events
-    while True:
-        if event_queue.next() is None:
-            break
+    sim.run()
+    if sim.recorder is not None:
+        sim.recorder.close()
+
+    if sim.profile is not None:
+        # one summary row per run, stored in its own table
+        return {'results': sim.snapshots,
+                'profile': [dict(args, **sim.profile.summary())]}
+    return sim.snapshots
+
+
+def simulator_batman_branches(args, warmup, variants):
+    """ Run args up to warmup, then every variant from a fork of it.
+
+    variants are dicts of parameters acting after the warm-up only, e.g.
+    drop_lim or strategy, overriding the ones in args. The snapshots of
+    the warm-up are shared by all the variants, and report their args.
+    Returns the snapshots of all the variants, one after the other.
+    """
+    sim = setup_simulation(args)
+    sim.run(until=warmup)
+
+    snapshots = []
+    for variant in variants:
+        branch = sim.fork()
+        branch.args = dict(sim.args, **variant)
+        branch.drop_lim = branch.args["drop_lim"]
+        branch.snapshots = [dict(snapshot, **variant)
+                            for snapshot in branch.snapshots]
+        branch.run()
+        snapshots.extend(branch.snapshots)
 
-    # Add last snapshot for final situation evaluation
     return snapshots
+
+
+def vectorised_strategy(args, mode):
+    """ Function of args['strategy'], which mode needs explicitly """
+    strategy = args.get("strategy")
+    if strategy not in STRATEGIES:
+        raise ValueError("The {} mode moves all the nodes at once: it needs "
+                         "args['strategy'] in {}, got {!r}".format(
+                             mode, sorted(STRATEGIES), strategy))
+    return STRATEGIES[strategy]
+
+
+def simulator_batman_batch(args):
+    """ Run the seeds in args['seeds'] of one scenario as a single batch.
+
+    Returns the snapshots of all the seeds, each with its own 's', like
+    the concatenated results of simulator_batman on every seed. The
+    strategy must be given, and vectorised.
+    """
+    strategy = vectorised_strategy(args, "batch")
+
+    args = dict(args)
+    seeds = args.pop("seeds")
+    sims = [setup_simulation(dict(args, s=s)) for s in seeds]
+    batch = Batch(sims,
+                  strategy,
+                  snapshot_time=SNAPSHOT_TIME,
+                  update_time=args["update_time"],
+                  thres_var=args.get("thres_var", THRES_VAR))
+    batch.run()
+
+    return batch.snapshots
+
+
+def simulator_batman_meanfield(args, until=None, substeps=1):
+    """ Mean-field counterpart of simulator_batman, see MeanField.
+
+    The geometry, the initial strategies and the apps are drawn as in
+    setup_simulation, so the run follows the scenario of the discrete
+    simulation with the same seed, and its snapshots have the same schema.
+    The strategy must be given, and vectorised.
+    """
+    strategy = vectorised_strategy(args, "mean-field")
+
+    node_num = args["node_num"]
+    random = Random(args["s"])
+    selfish = []
+    for ip in range(node_num):
+        selfish.append(random.random() < args["selfish_rate"])
+        random.random()
+        random.random()
+
+    # the draws of connect_apps: a pair of apps per selected pair of nodes
+    flow_src = []
+    flow_dst = []
+    for ip1 in range(node_num):
+        for ip2 in range(node_num):
+            if ip1 != ip2 and random.random() < args["app_rate"]:
+                flow_src += [ip1, ip2]
+                flow_dst += [ip2, ip1]
+
+    cached = geometry(args)
+    model = MeanField(selfish,
+                      cached['src'],
+                      cached['dst'],
+                      flow_src,
+                      flow_dst,
+                      strategy,
+                      drop_lim=args["drop_lim"],
+                      interarrival=INTERARRIVAL,
+                      size=(SIZE[0] + SIZE[1] - 1) / 2,
+                      stop_time=args["stop_time"],
+                      snapshot_time=SNAPSHOT_TIME,
+                      update_time=args["update_time"],
+                      thres_var=args.get("thres_var", THRES_VAR),
+                      substeps=substeps)
+    model.args = args
+
+    return model.run(until=until)
@@ -0,0 +1,100 @@
+""" Error of the mean-field mode against the discrete simulator """
+import argparse
+import multiprocessing as mp
+import time
+
+import pandas as pd
+
+from simulator.batch import TOTALS
+from simulator_starter import scenarios
+from test_batman import setup_simulation, simulator_batman_meanfield
+
+# parameters completing the scenarios of the sweep; the mean-field needs a
+# strategy moving all the nodes at once
+PARAMS = {'selfish_rate': 0.3, 'app_rate': 0.05, 'update_time': 1,
+          'drop_lim': 10, 'strategy': 'neighbour_majority'}
+SEEDS = [1000, 1001, 1002]
+
+
+def compare_run(args, until, substeps):
+    """ Error of the mean-field snapshots of args, with the wall times.
+
+    The error of a total is the sum of its absolute differences over the
+    snapshots of both modes, relative to the sum of the discrete values.
+    """
+    start = time.perf_counter()
+    sim = setup_simulation(args)
+    sim.run(until=until)
+    discrete_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    fluid = simulator_batman_meanfield(args, until=until, substeps=substeps)
+    fluid_time = time.perf_counter() - start
+
+    discrete = pd.DataFrame(sim.snapshots).set_index('time')
+    fluid = pd.DataFrame(fluid).set_index('time')
+    common = discrete.index.intersection(fluid.index)
+    discrete = discrete.loc[common, list(TOTALS)]
+    fluid = fluid.loc[common, list(TOTALS)]
+
+    row = {key: args[key] for key in ('dim', 'node_num', 's')}
+    row.update({
+        'snapshots': len(common),
+        'discrete_time': discrete_time,
+        'meanfield_time': fluid_time,
+        'speedup': discrete_time / fluid_time,
+    })
+    for total in TOTALS:
+        scale = discrete[total].abs().sum()
+        diff = (fluid[total] - discrete[total]).abs().sum()
+        row['error_' + total] = diff / scale if scale else float(diff > 0)
+    return row
+
+
+def _compare(task):
+    return compare_run(*task)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-s', '--seeds', type=int, nargs='+', default=SEEDS)
+    parser.add_argument('-u', '--until', type=float, default=5.0,
+                        help="simulated time compared, snapshots are "
+                        "taken up to it whatever their variation")
+    parser.add_argument('-t', '--topology', default='array',
+                        help="topology of the discrete runs; 'array' "
+                        "breaks ties between paths as the mean-field does")
+    parser.add_argument('-k', '--substeps', type=int, default=1,
+                        help="mean-field steps between two snapshots")
+    parser.add_argument('-p', '--processes', type=int, default=None)
+    parser.add_argument('-o', '--output', default=None,
+                        help="write the rows of every run to this CSV file")
+    args = parser.parse_args()
+
+    tasks = []
+    for scenario in scenarios:
+        for s in args.seeds:
+            # without thres_var=-1 both modes stop at their first snapshot
+            run = dict(scenario, s=s, topology=args.topology, thres_var=-1,
+                       **PARAMS)
+            tasks.append((run, args.until, args.substeps))
+
+    with mp.Pool(args.processes) as pool:
+        rows = pool.map(_compare, tasks)
+    runs = pd.DataFrame(rows)
+
+    summary = runs.groupby(['dim', 'node_num']).mean().drop(columns='s')
+    with pd.option_context('display.width', 200,
+                           'display.max_columns', None,
+                           'display.float_format', '{:.3f}'.format):
+        print(summary)
+    print("overall speedup {:.1f}, mean error {:.2%}".format(
+        runs['discrete_time'].sum() / runs['meanfield_time'].sum(),
+        runs[['error_' + total for total in TOTALS]].values.mean()))
+
+    if args.output is not None:
+        runs.to_csv(args.output, index=False)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,265 @@
+""" Writer process storing sweep results in large columnar batches """
+import datetime
+import multiprocessing as mp
+import os
+import queue
+import traceback
+
+import numpy as np
+import pandas as pd
+
+from sweep import Manifest, SweepAborted, to_block
+
+# dtypes of the snapshot columns; other columns keep the dtype of the
+# first batch written. Values are only cast safely: a float in an integer
+# column raises instead of being truncated
+SCHEMA = {
+    'time': np.float64,
+    'dim': np.float64,
+    'dist_lim': np.float64,
+    'node_num': np.int64,
+    'stop_time': np.float64,
+    'selfish_rate': np.float64,
+    'app_rate': np.float64,
+    's': np.int64,
+    'update_time': np.float64,
+    'drop_lim': np.float64,
+    'altruistic_tx': np.int64,
+    'altruistic_rx': np.int64,
+    'selfish_tx': np.int64,
+    'selfish_rx': np.int64,
+    'selfish_num': np.int64,
+    'altruistic_num': np.int64,
+}
+
+# room reserved for string columns in HDF5 tables
+STRING_SIZE = 32
+
+
+class WriterError(SweepAborted):
+    """ The writer process failed: the results queued are lost """
+
+
+def _fill(rows, dtype):
+    """ Values of a column missing from a block """
+    dtype = np.dtype(dtype)
+    if dtype.kind in 'UO':
+        return np.full(rows, '', dtype=dtype)
+    return np.zeros(rows, dtype=dtype)
+
+
+class ResultWriter:
+    """ Separate process appending results to HDF5 or Parquet files.
+
+    The sweep callbacks only put blocks in a queue; the writer concatenates
+    them and flushes every batch_rows rows, so the store is appended a few
+    times instead of once per simulation. Each table of the results (the
+    snapshots in 'results', the optional 'profile' rows) is a key of the
+    HDF5 files. HDF5 tables are written without indexes, which are built
+    once when the file is closed, and a new file is started every
+    runs_per_file runs. With parquet=True each batch is written as a
+    Parquet dataset per table in output_dir, partitioned by the
+    partition_cols it has.
+
+    With manifest_path, the args of the runs are appended to that manifest
+    only once their rows are written, so that a restarted sweep (with
+    Sweep(record=False)) skips exactly the runs already stored. If the
+    writer process fails, put() and close() raise WriterError in the
+    parent, with the traceback of the failure.
+    """
+    def __init__(self, output_dir, batch_rows=100000, runs_per_file=10000,
+                 parquet=False, partition_cols=('node_num',),
+                 queue_size=64, manifest_path=None):
+        self.output_dir = output_dir
+        self.batch_rows = batch_rows
+        self.runs_per_file = runs_per_file
+        self.parquet = parquet
+        self.partition_cols = list(partition_cols)
+        self.manifest_path = manifest_path
+
+        self.queue = mp.Queue(queue_size)
+        self.errors = mp.Queue()
+        self.failed = mp.Event()
+        self.error = None
+        self.process = mp.Process(target=self._loop, daemon=True)
+
+    def start(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        self.process.start()
+        return self
+
+    def put(self, args, result):
+        """ Queue the result of a run, or the block of a chunk of runs """
+        if not isinstance(args, list):
+            args = [args]
+            result = to_block([result])
+        self._send((args, result))
+
+    def close(self):
+        self._send(None)
+        self.process.join()
+        self._check()
+
+    def _check(self):
+        """ Raise WriterError if the writer process failed """
+        if not self.failed.is_set() and \
+           (self.process.is_alive() or self.process.exitcode == 0):
+            return
+        if self.error is None:
+            try:
+                self.error = self.errors.get(timeout=1)
+            except queue.Empty:
+                self.error = "exit code {}".format(self.process.exitcode)
+        raise WriterError("The result writer failed:\n" + self.error)
+
+    def _send(self, item):
+        # a dead writer never frees the queue: check it while waiting
+        while True:
+            self._check()
+            try:
+                self.queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    # everything below runs in the writer process
+
+    def _loop(self):
+        try:
+            self._run()
+        except BaseException:
+            self.errors.put(traceback.format_exc())
+            self.failed.set()
+
+    def _run(self):
+        self.time_str = datetime.datetime.utcnow().strftime(
+            '%Y-%m-%d-%H-%M-%S')
+        self.schema = dict(SCHEMA)
+        self.columns = {
+            # table: its columns, fixed by its first batch
+        }
+        self.buffer = {
+            # table: list of columnar blocks
+        }
+        self.buffer_rows = 0
+        # args of the runs in the buffer, recorded once written
+        self.buffer_runs = []
+        self.file_runs = 0
+        self.num_files = 0
+        self.store = None
+        self.manifest = None
+        if self.manifest_path is not None:
+            self.manifest = Manifest(self.manifest_path)
+
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+
+            runs, block = item
+            for table, columns in block.items():
+                if not columns:
+                    continue
+                self.buffer.setdefault(table, []).append(columns)
+                self.buffer_rows += len(next(iter(columns.values())))
+            self.buffer_runs.extend(runs)
+            self.file_runs += len(runs)
+
+            if self.buffer_rows >= self.batch_rows:
+                self._flush()
+            if self.runs_per_file and self.file_runs >= self.runs_per_file:
+                self._flush()
+                self._close_store()
+                self.file_runs = 0
+
+        self._flush()
+        self._close_store()
+        if self.manifest is not None:
+            self.manifest.close()
+
+    def _frame(self, table, blocks):
+        """ DataFrame of the blocks of table.
+
+        The columns are the union of the ones of the blocks, the values
+        missing from a block are filled with 0 (or ''). Since the stored
+        tables cannot change their columns, a column missing from the
+        first batch of a table raises ValueError.
+        """
+        keys = dict.fromkeys(self.columns.get(table, ()))
+        for block in blocks:
+            keys.update(dict.fromkeys(block))
+        if table in self.columns and len(keys) > len(self.columns[table]):
+            new = [key for key in keys if key not in self.columns[table]]
+            raise ValueError("Columns {} of table {!r} are missing from "
+                             "its first batch".format(new, table))
+        self.columns[table] = list(keys)
+
+        columns = {}
+        for key in keys:
+            dtype = next((block[key].dtype for block in blocks
+                          if key in block), self.schema.get(key, np.int64))
+            values = np.concatenate([
+                block[key] if key in block else
+                _fill(len(next(iter(block.values()))), dtype)
+                for block in blocks])
+            if key not in self.schema:
+                # lock the dtype of new columns on their first batch
+                self.schema[key] = values.dtype if values.dtype.kind != 'U' \
+                    else object
+            if not np.can_cast(values.dtype, self.schema[key], 'safe'):
+                raise ValueError("Column {!r} of table {!r} is {}, it cannot "
+                                 "be stored as {} without loss".format(
+                                     key, table, values.dtype,
+                                     np.dtype(self.schema[key])))
+            columns[key] = values.astype(self.schema[key], copy=False)
+        return pd.DataFrame(columns)
+
+    def _flush(self):
+        for table, blocks in self.buffer.items():
+            self._write(table, self._frame(table, blocks))
+        if self.store is not None:
+            self.store.flush(fsync=True)
+        if self.manifest is not None and self.buffer_runs:
+            self.manifest.extend(self.buffer_runs)
+        self.buffer = {}
+        self.buffer_rows = 0
+        self.buffer_runs = []
+
+    def _write(self, table, frame):
+        if self.parquet:
+            name = 'simulation_results.parquet' if table == 'results' \
+                else 'simulation_{}.parquet'.format(table)
+            # tables without the partition columns, as the end metrics of
+            # the sampler, are not partitioned
+            partition_cols = [key for key in self.partition_cols
+                              if key in frame]
+            frame.to_parquet(
+                os.path.join(self.output_dir, name),
+                partition_cols=partition_cols or None,
+                index=False)
+            return
+
+        if self.store is None:
+            path = os.path.join(
+                self.output_dir, "simulation_results_{}_{}.hdf5".format(
+                    self.num_files, self.time_str))
+            self.store = pd.HDFStore(path)
+            self.num_files += 1
+
+        strings = [key for key, dtype in self.schema.items()
+                   if dtype is object and key in frame]
+        self.store.append(table,
+                          frame,
+                          format='t',
+                          data_columns=True,
+                          index=False,
+                          min_itemsize={key: STRING_SIZE for key in strings})
+
+    def _close_store(self):
+        if self.store is None:
+            return
+        # indexing once at the end is much cheaper than on every append
+        for table in self.store.keys():
+            self.store.create_table_index(table, optlevel=6, kind='medium')
+        self.store.close()
+        self.store = None